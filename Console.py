@@ -1,7 +1,8 @@
 import cmd
+import os
 import re
 
-from Merging import ImageMerge, PixelProcess
+from Merging import BackgroundModel, FrameSource, ImageMerge, ImageWriter, Metrics, PixelProcess, ResultStore
 from Recognition import peopledetect
 from Recognition import TemplateMatcher
 from Recognition import Shift
@@ -21,6 +22,10 @@ class Console(cmd.Cmd):
         """
         cmd.Cmd.__init__(self)
         self.groups = None
+        # Set when the groups were read from the result store, which keeps no pixels to save.
+        self.storedGroups = 0
+        self.cleanup = (None, None, 0)
+        self.store = None
         self.m = ImageMerge.Merger(output)
         self.prompt = '> '
 
@@ -53,6 +58,76 @@ class Console(cmd.Cmd):
         Change the outfile to a new one, then merge any number of images."""
         paths = self.splitPaths(images)
         self.m.mergeAs(paths[0], *paths[1:])
+    def do_snapshot(self, arg):
+        """
+        Mark an undo point. Merges after it can be rolled back with undo."""
+        self.m.snapshot()
+    def do_undo(self, arg):
+        """
+        Roll the image back to the latest snapshot."""
+        if self.m.snapshots: self.m.undo()
+        else: print 'There is no snapshot to undo.'
+    def do_processes(self, count):
+        """
+        Split merges across <number> processes. One or nothing merges in this process."""
+        if count: self.m.processes = int(count)
+        else: self.m.processes = 1
+    def do_metrics(self, arg):
+        """
+        Report merge and save timings. Pass a path to append them to as JSON lines, log to
+        log them, or nothing to stop reporting."""
+        if arg == 'log': self.m.metrics = Metrics.LoggingSink()
+        elif arg: self.m.metrics = Metrics.JsonLinesSink(arg)
+        else: self.m.metrics = None
+
+
+    def do_scale(self, factor):
+        """
+        Read images at 1/<number> of their size, 2, 4 or 8, before any are merged.
+        Groups are reported at full size. One or nothing reads images at full size."""
+        if self.m.initialized: print 'Set the scale before the first merge.'
+        elif factor: self.m.scale = int(factor)
+        else: self.m.scale = 1
+    def do_sample(self, count):
+        """
+        Skip merges where none of <number> evenly spread pixels pass the check. This is an
+        estimate, changes between the samples are missed. Nothing turns it off."""
+        if count: self.m.sample = int(count)
+        else: self.m.sample = 0
+    def do_pyramid(self, factor):
+        """
+        Check squares of <number> pixels first, and merge only near squares that could hold
+        a change. Only colordiff can be checked this way. One or nothing merges every pixel."""
+        if factor: self.m.pyramid = int(factor)
+        else: self.m.pyramid = 1
+    def do_roi(self, arg):
+        """
+        Limit merges to rectangles, each given as <left top right bottom>. Any number may follow."""
+        values = [int(value) for value in arg.split()]
+        if not values or len(values) % 4: print 'Give four numbers per rectangle.'
+        else: self.m.setRegions(*[values[i:i + 4] for i in range(0, len(values), 4)])
+    def do_polyroi(self, arg):
+        """
+        Add a polygon, given as the <x y> of each corner, to the regions merges are limited to."""
+        values = [int(value) for value in arg.split()]
+        if len(values) < 6 or len(values) % 2: print 'Give the x and y of at least three corners.'
+        else: self.m.setRegions(*(self.m.regions + [zip(values[::2], values[1::2])]))
+    def do_clearroi(self, arg):
+        """
+        Stop limiting merges to regions."""
+        self.m.setRegions()
+    def do_sweep(self, arg):
+        """
+        Compare an image to the tracked one at several color differences without merging it.
+        Give the image then the differences, or nothing for every 16 up to 240."""
+        paths = self.splitPaths(arg)
+        thresholds = [int(value) for value in arg.split(paths[0], 1)[1].split()] or range(0, 256, 16)
+        histogram, results = self.m.sweep(paths[0], thresholds)
+        total = float(histogram.sum())
+        for threshold, count, groups in results:
+            largest = groups.first().count if groups.groups else 0
+            print "Difference", threshold, "Changed Pixels:", count, repr(round(count/total*100,2)) + '%', \
+                " Groups:", len(groups.groups), " Largest:", largest
 
 
     # These methods change the actions and checks used by the remote.
@@ -76,6 +151,26 @@ class Console(cmd.Cmd):
         self.m.processor.setCheckCommand(PixelProcess.ColorDiffCommand())
         if checknum: self.m.processor.checkcmd.diffnum = int(checknum)
         else: self.m.processor.checkcmd.diffnum = 0
+    def do_lumadiff(self, checknum):
+        """
+        Check a pair of pixels as true if their brightness differs by more than <number>."""
+        self.m.processor.setCheckCommand(PixelProcess.LumaDiffCommand())
+        if checknum: self.m.processor.checkcmd.diffnum = int(checknum)
+        else: self.m.processor.checkcmd.diffnum = 0
+    def do_labdiff(self, checknum):
+        """
+        Check a pair of pixels as true if their Lab colour difference, delta E, is more than
+        <number>. Around 2 is just noticeable."""
+        self.m.processor.setCheckCommand(PixelProcess.LabDiffCommand())
+        if checknum: self.m.processor.checkcmd.diffnum = float(checknum)
+        else: self.m.processor.checkcmd.diffnum = 0
+    def do_chromadiff(self, checknum):
+        """
+        Check a pair of pixels as true if their chromaticity, colour without brightness,
+        differs by more than <number> out of 255. Ignores shadows and lighting changes."""
+        self.m.processor.setCheckCommand(PixelProcess.ChromaDiffCommand())
+        if checknum: self.m.processor.checkcmd.diffnum = int(checknum)
+        else: self.m.processor.checkcmd.diffnum = 0
     def do_resetcommands(self, arg):
         """
         `Author` : Bill Clark
@@ -111,10 +206,59 @@ class Console(cmd.Cmd):
         """
         `Author` : Bill Clark
 
-        Generate the groups from the extract remote. Requires a merge to have happened."""
+        Generate the groups from the extract remote. Requires a merge to have happened.
+        Pass 8 to join diagonal pixels, otherwise only pixels sharing a side are joined.
+        Groups found at a reduced scale are rescaled to full size. Noise is removed first
+        as set by cleanup."""
         if isinstance(self.m.processor, PixelProcess.ExtractPixelRemote) \
           and self.m.processor.pixels is not None:
-            self.groups = self.m.processor.getGroupedPixels()
+            groups = PixelProcess.GroupContainer(*self.cleanup)
+            if arg: self.groups = self.m.processor.getGroupedPixels(int(arg), groups)
+            else: self.groups = self.m.processor.getGroupedPixels(groups=groups)
+            if self.m.scale != 1: self.groups.rescale(self.m.scale)
+            self.storedGroups = 0
+    def do_cleanup(self, arg):
+        """
+        Clean changed pixels before grouping them. Takes the <opening> and <closing> square
+        kernel sizes and the <minimum area> of a group. Zero skips a step, nothing turns
+        cleaning off."""
+        values = [int(value) for value in arg.split()]
+        if len(values) not in (0, 3): print 'Give the opening size, closing size and minimum area.'
+        elif values: self.cleanup = (values[0] or None, values[1] or None, values[2])
+        else: self.cleanup = (None, None, 0)
+    def do_pairgroups(self, images):
+        """
+        Merge an image onto a base and generate the groups, as merge then gengroups would.
+        With a result store open, groups found before for the same images and settings are
+        read from it instead of merging, and new groups are added to it. Groups read from the
+        store have no pixels, so they can't be saved. Needs the extract remote and nothing
+        merged yet, so the groups come from the pair alone."""
+        paths = self.splitPaths(images)
+        if not isinstance(self.m.processor, PixelProcess.ExtractPixelRemote):
+            print 'Pairgroups needs the extract remote.'
+            return
+        if self.m.initialized:
+            print 'Pairgroups needs a merger with nothing merged yet.'
+            return
+        key = None
+        if self.store is not None:
+            config = ResultStore.mergeConfig(self.m, 4, PixelProcess.GroupContainer(*self.cleanup))
+            key = self.store.key(paths[0], paths[1], config)
+            self.groups = self.store.get(key)
+            if self.groups is not None:
+                self.storedGroups = 1
+                return
+        self.m.processor.pixels = PixelProcess.ChangedPixels()
+        self.m.merge(*paths[:2])
+        self.do_gengroups(None)
+        if key is not None: self.store.put(key, self.groups)
+    def do_resultstore(self, path):
+        """
+        Keep pairgroups results in the store at <path>, or the default store if nothing is
+        given. Pass off to stop using a store."""
+        if self.store is not None: self.store.close()
+        if path == 'off': self.store = None
+        else: self.store = ResultStore.ResultStore(path or ResultStore.defaultPath)
     def do_showgroups(self, arg):
         """
         `Author` : Bill Clark
@@ -135,6 +279,11 @@ class Console(cmd.Cmd):
 
         Sort the groups by the number of pixels within the area."""
         if self.groups: self.groups.sortCount()
+    def do_topgroups(self, count):
+        """
+        Keep only the <number> largest groups, largest first, without sorting them all.
+        Nothing keeps the largest one."""
+        if self.groups: self.groups.keepTop(int(count) if count else 1)
     def do_ratiosortgroups(self, arg):
         """
         `Author` : Bill Clark
@@ -147,7 +296,8 @@ class Console(cmd.Cmd):
 
         Save the first group in the list to the output path."""
         if not path: print 'Specify the save path.'
-        if self.groups and path: self.groups.first().save(path, self.m.processor.pixels)
+        elif self.storedGroups: print 'These groups came from the result store, which has no pixels to save.'
+        elif self.groups: self.groups.first().save(path, self.m.processor.pixels)
 
 
     # These methods use external modules to provide merging and utilities. They
@@ -197,6 +347,50 @@ class Console(cmd.Cmd):
         Save the image."""
         self.m.save()
         # print self.m.outfile
+    def do_asyncsave(self, arg):
+        """
+        Save images in the background, so saving doesn't hold up the next merge.
+        Pass off to write any waiting saves and go back to saving straight away."""
+        if arg == 'off':
+            if self.m.writer is not None: self.m.writer.close()
+            self.m.writer = None
+        elif self.m.writer is None: self.m.writer = ImageWriter.ImageWriter()
+    def do_background(self, arg):
+        """
+        Keep a background for the frame command, as <ema [alpha]>, <mean> or <median [step]>.
+        Add selective to leave changed pixels out of it. Pass off to forget it."""
+        args = arg.split()
+        selective = 'selective' in args
+        if selective: args.remove('selective')
+        if not args or args[0] == 'off': self.m.background = None
+        elif args[0] == 'ema' and len(args) > 1:
+            self.m.background = BackgroundModel.BackgroundModel('ema', alpha=float(args[1]), selective=selective)
+        elif args[0] == 'median' and len(args) > 1:
+            self.m.background = BackgroundModel.BackgroundModel('median', step=int(args[1]), selective=selective)
+        elif args[0] in ('ema', 'mean', 'median'):
+            self.m.background = BackgroundModel.BackgroundModel(args[0], selective=selective)
+        else: print 'Use ema, mean, median or off.'
+    def do_frame(self, arg):
+        """
+        Merge frames onto the background, each on its own, then add them to it."""
+        for path in self.splitPaths(arg):
+            print path, self.m.mergeFrame(path)
+    def do_stream(self, arg):
+        """
+        Merge the frames of a <video or directory>, keeping one in every [number], and print
+        each frame's changed pixels and groups. The last frame's groups are kept."""
+        path, skip = arg.strip(), 0
+        match = re.match(r'(.*\S)\s+(\d+)$', path)
+        if match and not os.path.exists(path): path, skip = match.group(1), int(match.group(2)) - 1
+        if not path: return
+        if skip < 0:
+            print 'Keep one frame in a number of at least 1.'
+            return
+        source = FrameSource.frames(path, skip, buffer=4)
+        for index, counter, groups in FrameSource.groupFrames(self.m, source, groups=PixelProcess.GroupContainer(*self.cleanup)):
+            print index, counter, len(groups.groups)
+            self.groups = groups
+            self.storedGroups = 0
     def do_show(self, arg):
         """
         `Author` : Bill Clark
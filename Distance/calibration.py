@@ -1,6 +1,7 @@
 from __future__ import division
 import sys, json, os, math
 import Console, argparse
+from Merging import ResultStore
 
 """
 The main function of this script will write to the fixed location file, json/calib_info.json, the information pertinent to the distance_finder.py module
@@ -34,11 +35,12 @@ Example ARGS:
 directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 calib_file = os.path.join(directory, 'Distance', 'json', 'calib_info.json')  # destination of calibration storage
 
-def find_object_px(base_file, obj_file):
+def find_object_px(base_file, obj_file, results=None):
     """
     This method will be find the height of the found object in pixels
     to be used essential to every distance method
 
+    `results` optional ResultStore, groups found for this pair before are read back from it
     `return` the object height in pixels, as determined by the Image_merge module via console
     """
     consolas = Console.Console('Output/ImF.png')
@@ -46,11 +48,9 @@ def find_object_px(base_file, obj_file):
     consolas.do_redhighlight(None)
     consolas.do_colordiff(120)
 
-    consolas.do_merge(base_file)
-    consolas.do_merge(obj_file)
-
-    consolas.do_gengroups(None)
-    consolas.do_countsortgroups(None)
+    consolas.store = results
+    consolas.do_pairgroups(base_file + ' ' + obj_file)
+    consolas.do_topgroups(None)
     first = consolas.groups.first()
 
     return first.height
@@ -95,6 +95,8 @@ def run_me():
                     required=False, help="base image file for image merge")
     ap.add_argument("--calib",  metavar="FILE",
                     required=False, help="calibration image file for image merge")
+    ap.add_argument("--results", metavar="FILE", required=False,
+                    help="a result store database, groups found for the images before are read back from it")
 
     args = ap.parse_args()
 
@@ -104,7 +106,11 @@ def run_me():
         calib_image = str(args.calib)
         height_object_in_question = args.known_height_m
         dist_object_in_question = args.known_distance_m
-        object_height_px = find_object_px(base_image, calib_image)
+        results = ResultStore.ResultStore(args.results) if args.results is not None else None
+        try:
+            object_height_px = find_object_px(base_image, calib_image, results)
+        finally:
+            if results is not None: results.close()
 
         focal_len = calibrate_focal_len(dist_object_in_question, height_object_in_question, object_height_px)   # find focal len px
 
@@ -2,6 +2,7 @@ from __future__ import division
 from PIL import Image, ImageDraw, ImageFont
 from PIL.ExifTags import TAGS
 import math, os, traceback, sys, warnings, json, Console, argparse
+from Merging import FrameStore, ResultStore
 from pprint import pprint
 
 
@@ -64,6 +65,9 @@ class Solution:
         self.obj_file = obj_file
         self.height_object_in_question = known_height
         self.focal_len = None
+        self.scale = 1
+        self.store = None
+        self.results = None
 
         with open(os.path.join(directory, 'Distance', 'json', 'cameras.json'), 'r') as data_file:
             data = json.load(data_file)
@@ -88,24 +92,31 @@ class Solution:
         This method should will be finished to find the height of the found object in pixels
         to be used essential to every distance method
 
+        When self.scale is 2, 4 or 8 the images are decoded and compared at that fraction of their size,
+        and the object's height and location are scaled back to full resolution pixels
+        When self.store is a FrameStore, images held in it are memory mapped from it instead of decoded
+        When self.results is a ResultStore, groups found for the pair before are read back from it
+
         `path` the path to the image file being investigated
         `return` (obj_height, img_height) the height of the object in px, and the height of the image in pixels
         """
 
+        # only the header is read for the size, the merge below decodes obj_file at self.scale
+        img_width, img_height = Image.open(obj_file).size
+
         # the following are console commands to employ image merge
-        im = Image.open(obj_file)
-        img_width, img_height = im.size
 
         consolas = Console.Console('Output/ImF.png')
+        consolas.do_scale(self.scale)
         consolas.do_extractremote(None)
         consolas.do_redhighlight(None)
         consolas.do_colordiff(120)
 
-        consolas.do_merge(base_file)
-        consolas.do_merge(obj_file)
-
-        consolas.do_gengroups(None)
-        consolas.do_countsortgroups(None)
+        consolas.store = self.results
+        if self.store is not None:
+            base_file, obj_file = self.store.lookup(base_file), self.store.lookup(obj_file)
+        consolas.do_pairgroups(base_file + ' ' + obj_file)
+        consolas.do_topgroups(None)
         first = consolas.groups.first()
 
         return first.height, img_height, first.x, first.y
@@ -438,10 +449,16 @@ def parse_args():
                     required=True, help="base image file for image merge")
     ap.add_argument("--files", nargs='+', metavar="FILE", required=True,
                     help="The list of files to be merged against base, the distance of the highlight in each will be found")
+    ap.add_argument("--scale", type=int, choices=[1, 2, 4, 8], default=1,
+                    help="decode and compare the images at 1/scale of their size, faster for large JPEGs")
+    ap.add_argument("--store", metavar="DIR", required=False,
+                    help="a frame store built by other_tools/build_frame_store.py, stored images are read from it")
+    ap.add_argument("--results", metavar="FILE", required=False,
+                    help="a result store database, groups found for the images before are read back from it")
     args = ap.parse_args()
     return args
 
-def run_me(known_height, method_flags, base_file, infiles):
+def run_me(known_height, method_flags, base_file, infiles, scale=1, store=None, results=None):
     """
     run me method for scripting usage
     for deployment usage see additional example args at file head
@@ -453,17 +470,28 @@ def run_me(known_height, method_flags, base_file, infiles):
     `method_flags` the list of flags chosen to denote the choice of method used to solve (P - primary,S -secondary, etc.)
     `base_file` the base file against which all infiles will be checked and distance solved
     `infiles` the lis tof file being examined for difference, and determining distance
+    `scale` the fraction, 1, 2, 4 or 8, of their size the images are compared at
+    `store` the directory of a frame store to read stored images from, if any
+    `results` the database file of a result store to share across the run, if any
     `return` the list of results of upon execution
     """
 
     configs = {'P': Primary, 'S': Secondary, 'T': Tertiary, 'Q': Quaternary, 'L': Linear}
     df = Macro()
+    if store is not None: store = FrameStore.FrameStore(store)
+    if results is not None: results = ResultStore.ResultStore(results)
     for flag in method_flags:
         for obj_file in infiles:
-            df.add(configs[flag.upper()](known_height=known_height, obj_file=obj_file, base_file=base_file))
+            solution = configs[flag.upper()](known_height=known_height, obj_file=obj_file, base_file=base_file)
+            solution.scale = scale
+            solution.store = store
+            solution.results = results
+            df.add(solution)
 
-    results = df.run()
-    return list(results)
+    try:
+        return list(df.run())
+    finally:
+        if results is not None: results.close()
 
 def main():
     """
@@ -478,7 +506,7 @@ def main():
         print '\t', arg, getattr(args, arg)
 
     files = args.files
-    results = run_me(known_height=args.known_height_m, method_flags=args.methods, base_file=args.base,infiles=files)
+    results = run_me(known_height=args.known_height_m, method_flags=args.methods, base_file=args.base,infiles=files, scale=args.scale, store=args.store, results=args.results)
 
     # print results
     print '\n', color.UNDERLINE, 'Results:', ' ' * 50, color.END, '\n'
@@ -0,0 +1,98 @@
+import numpy
+from PIL import Image
+
+import ImageCache
+
+
+class BackgroundModel(object):
+
+    def __init__(self, method='ema', alpha=0.05, step=1, selective=False):
+        """
+        A background model is a base image that follows a static camera's scene as the light
+        drifts, built up from the frames it is shown. Each update is a few array operations
+        over the frame's pixels. Three methods are offered:
+        ema, an exponential moving average. Each frame moves the background alpha of the way
+        towards it, so older frames fade out.
+        mean, the average of every frame so far.
+        median, an approximate running median. Each frame moves every value of the background
+        step towards it, which settles on the median of recent frames and ignores brief
+        changes better than either average.
+        With selective set, pixels a merge found changed are left out of the update, so an
+        object that stops in view takes longer to become background.
+
+        `method`: ema, mean or median.
+
+        `alpha`: How far each frame moves an ema background, from 0 to 1.
+
+        `step`: How far each frame moves a median background, in values.
+
+        `selective`: Leave changed pixels out of updates.
+        """
+        if method not in ('ema', 'mean', 'median'):
+            raise ValueError('The method must be ema, mean or median.')
+        self.method = method
+        self.alpha = alpha
+        self.step = step
+        self.selective = selective
+
+        self.state = None
+        self.mode = None
+        self.count = 0
+
+    def update(self, frame, mask=None):
+        """
+        Adds a frame to the model. The first frame becomes the background as it is.
+
+        `frame`: Path to the frame, or a frame in memory. It must match the first frame's
+        size and mode.
+
+        `mask`: Optional boolean array of the frame's height and width. Pixels true in it are
+        not updated.
+        """
+        data, mode = ImageCache.load(frame)
+        if self.state is None:
+            self.state = data.astype(numpy.uint8 if self.method == 'median' else numpy.float32)
+            self.mode = mode
+            self.count = 1
+            return
+        if mode != self.mode or data.shape != self.state.shape:
+            raise ValueError('Frames must match the background in size and mode.')
+
+        self.count += 1
+        if self.method == 'median':
+            state = self.state.astype(numpy.int16)
+            update = numpy.clip(data.astype(numpy.int16) - state, -self.step, self.step)
+        else:
+            rate = self.alpha if self.method == 'ema' else 1.0 / self.count
+            update = (data - self.state) * numpy.float32(rate)
+        if mask is not None: update[mask] = 0
+
+        if self.method == 'median': self.state = (state + update).astype(numpy.uint8)
+        else: self.state += update
+
+    def array(self):
+        """
+        The background as a uint8 array, shaped like the frames.
+
+        `return`: The array, or None before the first update.
+        """
+        if self.state is None: return None
+        if self.method == 'median': return self.state
+        return numpy.rint(self.state).astype(numpy.uint8)
+
+    def image(self):
+        """
+        The background as a PIL image.
+
+        `return`: The image, or None before the first update.
+        """
+        if self.state is None: return None
+        return Image.fromarray(self.array(), self.mode)
+
+    def reset(self):
+        """
+        Forgets every frame, so the next one becomes the background.
+        """
+        self.state = None
+        self.mode = None
+        self.count = 0
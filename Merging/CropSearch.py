@@ -0,0 +1,87 @@
+import numpy
+
+# The order sides are preferred in when several match at the same location.
+_sidePriority = (3, 1, 2, 0)
+
+
+def findSides(image, sides, tolerance=5, budget=64 * 2**20):
+    """
+    Finds the first location where any of a set of pixel rows appears in an image. A side
+    matches at (x, y) if every pixel of it is within tolerance, in every channel, of the
+    image's row y starting at column x. Locations are searched in raster order, and when
+    more than one side matches at the first location the last listed side is preferred,
+    the same as Merger.cropFind has always done.
+    Candidates are found with FFT cross correlation. The sum of squared differences between
+    a side and every window of a row is worked out from one correlation per band of rows,
+    and a window can only match if that sum is at most tolerance squared per value. The
+    few windows that pass are then checked pixel by pixel. Bands are searched top down,
+    and the search stops at the first band with a match.
+
+    `image`: Array of the image to search, shaped (height, width, channels).
+
+    `sides`: Arrays of pixels, shaped (length, channels), to look for.
+
+    `tolerance`: The largest difference allowed in any channel of a matching pixel.
+
+    `budget`: The number of bytes the spectra of one band may use.
+
+    `return`: (x, y, side index) of the match, or None if nothing matches.
+    """
+    height, width = image.shape[:2]
+    channels = min([image.shape[2]] + [side.shape[1] for side in sides])
+    size = 1 << (width - 1).bit_length()
+    rows = max(1, budget // ((size // 2 + 1) * channels * 16))
+
+    sides = [numpy.asarray(side, numpy.int16)[:, :channels] for side in sides]
+    spectra = [numpy.conj(numpy.fft.rfft(side, size, axis=0)) for side in sides]
+    limits = [tolerance ** 2 * side.size + 1e-6 * 255 ** 2 * side.size + 1 for side in sides]
+
+    for top in xrange(0, height, rows):
+        band = image[top:top + rows, :, :channels].astype(numpy.int16)
+        values = band.astype(numpy.float64)
+        spectrum = numpy.fft.rfft(values, size, axis=1)
+        squares = numpy.zeros((len(band), width + 1))
+        squares[:, 1:] = numpy.cumsum((values ** 2).sum(axis=-1), axis=1)
+
+        found = {}
+        for index, side in enumerate(sides):
+            length = len(side)
+            positions = width - length + 1
+            if positions <= 0 or length == 0: continue
+
+            correlation = numpy.fft.irfft((spectrum * spectra[index]).sum(axis=-1), size, axis=1)[:, :positions]
+            distance = squares[:, length:] - squares[:, :positions] - 2 * correlation + (side.astype(numpy.float64) ** 2).sum()
+            ys, xs = numpy.nonzero(distance <= limits[index])
+            ys, xs = _verify(band, side, ys, xs, tolerance)
+            if len(ys):
+                first = numpy.lexsort((xs, ys))[0]
+                found[index] = (int(ys[first]), int(xs[first]))
+
+        if found:
+            y, x = min(found.values())
+            for index in _sidePriority:
+                if found.get(index) == (y, x):
+                    return x, top + y, index
+    return None
+
+
+def _verify(band, side, ys, xs, tolerance):
+    """
+    Checks candidate windows pixel by pixel, dropping a candidate at its first pixel that
+    differs by more than the tolerance.
+
+    `band`: int16 array of the rows being searched.
+
+    `side`: int16 array of the side's pixels.
+
+    `ys`: Row of each candidate within the band.
+
+    `xs`: Starting column of each candidate.
+
+    `return`: The rows and columns of the candidates that match.
+    """
+    for k in xrange(len(side)):
+        if not len(ys): break
+        same = (numpy.abs(band[ys, xs + k] - side[k]) <= tolerance).all(axis=-1)
+        ys, xs = ys[same], xs[same]
+    return ys, xs
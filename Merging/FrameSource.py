@@ -0,0 +1,151 @@
+import Queue
+import itertools
+import os
+import sys
+import threading
+
+import ImageCache
+import PixelProcess
+
+# File extensions read as frames from a directory.
+imageExtensions = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif', '.tiff')
+
+# Put on a frame queue to end the frames read from it.
+endOfFrames = object()
+
+
+def frames(source, skip=0, buffer=0):
+    """
+    Reads frames from a video, a directory of images or a queue, one at a time, without
+    writing anything to disk. Each frame is yielded as its index in the source and the frame,
+    which can be given anywhere an image path is taken.
+    Video is read with cv2.VideoCapture, and its frames are yielded as ImageCache.BGR arrays.
+    A directory's images are yielded as paths, in name order. A queue's items are yielded
+    until endOfFrames is taken from it.
+
+    `source`: A video path, a directory path, a camera number or a Queue.
+
+    `skip`: How many frames to skip after each one yielded, zero or more. Skipped video
+    frames are grabbed but never decoded.
+
+    `buffer`: If above zero, frames are read ahead on a background thread, holding at most
+    this many, so reading the next frame overlaps working on this one.
+
+    `return`: A generator of (index, frame) pairs.
+    """
+    if skip < 0: raise ValueError('Skip must be zero or more.')
+    if isinstance(source, (Queue.Queue, int)) or not os.path.isdir(source):
+        if isinstance(source, Queue.Queue): reader = _queueFrames(source, skip)
+        else: reader = _videoFrames(source, skip)
+    else:
+        reader = _directoryFrames(source, skip)
+    if buffer > 0: reader = _buffered(reader, buffer)
+    return reader
+
+
+def groupFrames(merger, source, connectivity=4, groups=None, top=None):
+    """
+    Merges a stream of frames and groups the pixels each one changes. With a background model
+    set on the merger, each frame is merged onto the background with mergeFrame. Otherwise
+    each frame is merged onto the result of the frames before it. The first frame only
+    starts the merger, and its result has no groups.
+    Groups are rescaled to full size units when the merger reads at a reduced scale.
+
+    `merger`: A Merger with an ExtractPixelRemote.
+
+    `source`: Frames from the frames function, or any iterable of (index, frame) pairs.
+
+    `connectivity`: 4 to join pixels that share a side, 8 to also join diagonals.
+
+    `groups`: A group container whose cleanup settings are used for every frame.
+
+    `top`: If given, only the largest groups up to this many are kept per frame.
+
+    `return`: A generator of (index, changed count, group container) per frame.
+    """
+    if not isinstance(merger.processor, PixelProcess.ExtractPixelRemote):
+        raise ValueError('Grouping frames needs an ExtractPixelRemote.')
+    cleanup = (None, None, 0) if groups is None else (groups.opening, groups.closing, groups.minArea)
+
+    for index, frame in source:
+        found = PixelProcess.GroupContainer(*cleanup)
+        if merger.background is not None:
+            counter = merger.mergeFrame(frame)
+        elif not merger.initialized:
+            merger.setup(frame)
+            counter = 0
+        else:
+            merger.processor.pixels = PixelProcess.ChangedPixels()
+            counter = merger.checkAndAct(frame)
+            if merger.autoSave: merger.save()
+        if counter:
+            found = merger.processor.getGroupedPixels(connectivity, found)
+            if merger.scale != 1: found.rescale(merger.scale)
+            if top is not None: found.keepTop(top)
+        yield index, counter, found
+
+
+def _videoFrames(source, skip):
+    """
+    Reads the frames of a video or camera with cv2. Skipped frames are grabbed, which
+    advances the video without decoding them.
+    """
+    import cv2
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened(): raise IOError('Could not open video %s.' % source)
+    try:
+        for index in itertools.count():
+            if index % (skip + 1):
+                if not capture.grab(): return
+                continue
+            found, frame = capture.read()
+            if not found: return
+            yield index, ImageCache.BGR(frame)
+    finally:
+        capture.release()
+
+
+def _directoryFrames(directory, skip):
+    """
+    Lists the images of a directory in name order, as frame paths.
+    """
+    names = sorted(name for name in os.listdir(directory) if os.path.splitext(name)[1].lower() in imageExtensions)
+    for index in range(0, len(names), skip + 1):
+        yield index, os.path.join(directory, names[index])
+
+
+def _queueFrames(queue, skip):
+    """
+    Takes frames from a queue until endOfFrames is taken.
+    """
+    for index in itertools.count():
+        frame = queue.get()
+        if frame is endOfFrames: return
+        if not index % (skip + 1): yield index, frame
+
+
+def _buffered(reader, size):
+    """
+    Runs a frame reader on a background thread, holding at most size frames it has read
+    ahead. An error raised by the reader is raised again where the frames are used.
+    Stopping early leaves the thread waiting on the full buffer; it is a daemon thread, so
+    it won't keep the program running.
+    """
+    buffer = Queue.Queue(size)
+
+    def run():
+        try:
+            for item in reader:
+                buffer.put((item, None))
+        except Exception:
+            buffer.put((None, sys.exc_info()))
+        buffer.put((endOfFrames, None))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, error = buffer.get()
+        if error is not None: raise error[0], error[1], error[2]
+        if item is endOfFrames: return
+        yield item
@@ -0,0 +1,124 @@
+import itertools
+import json
+import os
+
+import numpy
+from PIL import Image
+
+import FrameSource
+import ImageCache
+
+# The name of the index file in a store's directory.
+indexName = 'index.json'
+
+
+class FrameStore(object):
+
+    def __init__(self, path):
+        """
+        A directory of images decoded once into raw .npy pixel files, for image sets that are
+        analysed over and over. Reading a stored frame memory maps it, so no decoding is done
+        and only the parts of a frame that are used are read from disk. Each frame's path can
+        be given anywhere an image path is taken, as ImageCache maps .npy files.
+        The store's index file lists every frame by the name of the image it came from, with
+        its mode, shape, and the modification time and size the image had when it was stored.
+        Frames are stored at full size. Reading one at a reduced scale shrinks it, which can
+        differ slightly from the JPEG draft decoding the original would get.
+
+        `path`: The store's directory, made by build.
+        """
+        self.path = path
+        with open(os.path.join(path, indexName)) as fp:
+            self.index = json.load(fp)
+
+    def names(self):
+        """
+        The names of the stored images, in name order.
+        """
+        return sorted(self.index)
+
+    def frame(self, name):
+        """
+        Finds the raw file of a stored image.
+
+        `name`: The image's file name, or a path to it.
+
+        `return`: The path of the .npy file.
+        """
+        return os.path.join(self.path, self.index[os.path.basename(name)]['frame'])
+
+    def array(self, name):
+        """
+        Memory maps a stored image.
+
+        `name`: The image's file name, or a path to it.
+
+        `return`: A read only array of the pixels, shaped (height, width, channels) for colour
+        images.
+        """
+        return ImageCache.array(self.frame(name))
+
+    def size(self, name):
+        """
+        The width and height of a stored image, read from the index.
+        """
+        shape = self.index[os.path.basename(name)]['shape']
+        return shape[1], shape[0]
+
+    def lookup(self, path):
+        """
+        Swaps an image path for its stored frame, if the store holds the image as it is now.
+        An image changed since it was stored, or not stored at all, keeps its own path.
+
+        `path`: Path to an image.
+
+        `return`: The path to read the image from.
+        """
+        entry = self.index.get(os.path.basename(path))
+        if entry is None: return path
+        if os.path.exists(path):
+            stat = os.stat(path)
+            if (stat.st_mtime, stat.st_size) != (entry['mtime'], entry['size']): return path
+        return os.path.join(self.path, entry['frame'])
+
+
+def build(directory, path):
+    """
+    Decodes every image of a directory into a frame store, or brings an existing store up to
+    date. Images stored before and unchanged since are skipped, and frames of images that are
+    gone are removed. Frames are numbered as they are first stored, and an image stored again
+    keeps its number, so no two images share a frame file.
+
+    `directory`: The directory of images.
+
+    `path`: The store's directory. It is made if needed.
+
+    `return`: The FrameStore.
+    """
+    if not os.path.isdir(path): os.makedirs(path)
+    index = {}
+    if os.path.exists(os.path.join(path, indexName)): index = FrameStore(path).index
+
+    used = set(entry['frame'] for entry in index.itervalues())
+    numbers = (number for number in itertools.count() if 'frame%d.npy' % number not in used)
+
+    names = [name for name in os.listdir(directory) if os.path.splitext(name)[1].lower() in FrameSource.imageExtensions]
+    for name in set(index) - set(names):
+        os.remove(os.path.join(path, index.pop(name)['frame']))
+
+    for name in sorted(names):
+        stat = os.stat(os.path.join(directory, name))
+        entry = index.get(name)
+        if entry is not None and (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size): continue
+
+        image = Image.open(os.path.join(directory, name))
+        if image.mode not in ('L', 'RGB', 'RGBA'): image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        data = numpy.asarray(image)
+        frame = entry['frame'] if entry is not None else 'frame%d.npy' % next(numbers)
+        numpy.save(os.path.join(path, frame), data)
+        index[name] = {'frame': frame, 'mode': image.mode, 'shape': data.shape,
+                       'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    with open(os.path.join(path, indexName), 'w') as fp:
+        json.dump(index, fp, indent=1, sort_keys=True)
+    return FrameStore(path)
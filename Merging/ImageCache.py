@@ -0,0 +1,275 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy
+from PIL import Image
+
+# Modes that survive a round trip through a numpy array.
+_arrayModes = ('L', 'RGB', 'RGBA')
+
+
+class ImageCache(object):
+
+    def __init__(self, budget=512 * 2**20):
+        """
+        A cache of decoded images, shared by everything in the process that reads images from
+        disk. Entries are keyed by the file's real path, modification time and size, so an
+        edited file is decoded again. The least recently used entries are dropped once the
+        decoded pixels take up more than the budget.
+        The cached pixels are handed out as read only numpy arrays. Callers that need to
+        modify an image get their own PIL copy from image.
+        Images can also be read at a reduced scale of 2, 4 or 8. JPEG files are then decoded
+        at that scale directly, using the DCT scaling of their draft mode, which skips most of
+        the decoding work. Other formats are decoded in full and shrunk. A scaled image is
+        always the full size divided by the scale and rounded up, so coordinates in it can be
+        multiplied back to full resolution.
+        Images already in memory can be given in place of a path, as a PIL image, a numpy array
+        or a BGR wrapped array from cv2. These are never cached. Arrays are used without copying
+        where their layout allows, PIL images are copied once into an array.
+        Paths to .npy files, such as the frames of a FrameStore, are memory mapped instead of
+        decoded. They are not cached either, the mapped pages are already shared through the
+        operating system's file cache.
+
+        `budget`: The most bytes of decoded pixels to keep.
+        """
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, path, scale=1):
+        """
+        Finds the decoded pixels of an image file, decoding it if they aren't cached. Images
+        in modes that don't convert to arrays cleanly, such as palette images, are decoded
+        every time.
+
+        `path`: Path to the image, or an image in memory.
+
+        `scale`: Divide the image's size by 1, 2, 4 or 8.
+
+        `return`: A read only array of the pixels, and the image's mode.
+        """
+        if not isinstance(path, basestring): return _loadMemory(path, scale)
+        if path.lower().endswith('.npy'): return _loadMemory(numpy.load(path, mmap_mode='r'), scale)
+
+        key = fileKey(path)
+        if scale != 1: key += (scale,)
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry
+
+        image = _open(path, scale)
+        data = numpy.asarray(image)
+        data.flags.writeable = False
+        entry = data, image.mode
+        if image.mode in _arrayModes: self._add(key, entry)
+        return entry
+
+    def array(self, path, bgr=False, scale=1):
+        """
+        The pixels of an image file as a read only array.
+
+        `path`: Path to the image, or an image in memory.
+
+        `bgr`: Return three channels in the blue, green, red order of cv2.imread.
+
+        `scale`: Divide the image's size by 1, 2, 4 or 8.
+
+        `return`: The array, shaped (height, width, channels) for colour images.
+        """
+        if not bgr: return self.load(path, scale)[0]
+        if isinstance(path, BGR) and scale == 1 and numpy.ndim(path.array) == 3: return _readOnly(path.array[..., :3])
+        if not isinstance(path, basestring): return _toBGR(*self.load(path, scale))
+
+        key = fileKey(path) + ('BGR',)
+        if scale != 1: key += (scale,)
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry[0]
+
+        data, mode = self.load(path, scale)
+        if mode not in _arrayModes: return data
+        data = _toBGR(data, mode)
+        self._add(key, (data, 'BGR'))
+        return data
+
+    def image(self, path, scale=1):
+        """
+        An image file as a PIL image of its own, which may be modified freely.
+
+        `path`: Path to the image, or an image in memory.
+
+        `scale`: Divide the image's size by 1, 2, 4 or 8.
+
+        `return`: The image.
+        """
+        if isinstance(path, Image.Image) and scale == 1: return path.copy()
+        data, mode = self.load(path, scale)
+        if mode not in _arrayModes: return _open(path, scale)
+        image = Image.fromarray(data, mode)
+        if image.readonly: image = image.copy()
+        return image
+
+    def _add(self, key, entry):
+        """
+        Stores an entry, then drops the least recently used entries until the cache fits its
+        budget. Entries larger than the whole budget are not stored.
+        """
+        size = entry[0].nbytes
+        if size > self.budget: return
+        with self.lock:
+            if key in self.entries: return
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.budget:
+                key, entry = self.entries.popitem(last=False)
+                self.size -= entry[0].nbytes
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def fileKey(path):
+    """
+    Identifies a file by its real path, modification time and size. Two reads of a file with
+    the same key find the same contents. A file that can't be read raises IOError, as
+    opening it would.
+
+    `path`: Path to the file.
+
+    `return`: The key, a tuple.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        raise IOError(error.errno, error.strerror, path)
+    return os.path.realpath(path), stat.st_mtime, stat.st_size
+
+
+class BGR(object):
+
+    def __init__(self, array):
+        """
+        Marks an array as holding its channels in blue, green, red order, as cv2.imread and
+        cv2.VideoCapture give them, so it can be passed anywhere a path is taken.
+
+        `array`: The image array, shaped (height, width, 3 or 4) or (height, width).
+        """
+        self.array = array
+
+
+def _loadMemory(source, scale):
+    """
+    Does the work of load for an image in memory. A uint8 array is read as an L, RGB or
+    RGBA image by its number of channels, and is only copied if it must be scaled. A BGR
+    array is viewed in reverse channel order, which needs no copy for three channels.
+
+    `source`: A PIL image, a numpy array or a BGR wrapped array.
+
+    `scale`: Divide the image's size by 1, 2, 4 or 8.
+
+    `return`: A read only array of the pixels, and the image's mode.
+    """
+    if isinstance(source, Image.Image):
+        if source.mode not in _arrayModes: source = source.convert('RGBA' if 'A' in source.mode else 'RGB')
+        data, mode = numpy.asarray(source), source.mode
+    else:
+        data = source.array if isinstance(source, BGR) else numpy.asarray(source)
+        if data.dtype != numpy.uint8 or data.ndim not in (2, 3) or (data.ndim == 3 and data.shape[2] not in (3, 4)):
+            raise ValueError('Image arrays must be uint8, shaped (height, width) or (height, width, 3 or 4).')
+        mode = 'L' if data.ndim == 2 else ('RGB', 'RGBA')[data.shape[2] - 3]
+        if isinstance(source, BGR) and data.ndim == 3:
+            data = data[..., 2::-1] if mode == 'RGB' else data[..., [2, 1, 0, 3]]
+
+    if scale != 1:
+        if scale not in (2, 4, 8): raise ValueError('Images can only be scaled by 1, 2, 4 or 8.')
+        size = -(-data.shape[1] // scale), -(-data.shape[0] // scale)
+        data = numpy.asarray(Image.fromarray(numpy.ascontiguousarray(data), mode).resize(size, Image.BOX))
+    return _readOnly(data), mode
+
+
+def _readOnly(data):
+    """
+    A read only view of an array, leaving the array itself writeable.
+    """
+    data = data.view()
+    data.flags.writeable = False
+    return data
+
+
+def _toBGR(data, mode):
+    """
+    Converts an L, RGB or RGBA array from load to the three channel blue, green, red order
+    of cv2.imread.
+    """
+    if mode == 'L': data = numpy.dstack((data, data, data))
+    else: data = numpy.ascontiguousarray(data[..., 2::-1])
+    data.flags.writeable = False
+    return data
+
+
+def _open(path, scale):
+    """
+    Opens an image file at a reduced scale, using JPEG draft mode where it can.
+
+    `path`: Path to the image.
+
+    `scale`: Divide the image's size by 1, 2, 4 or 8.
+
+    `return`: The image, loaded.
+    """
+    image = Image.open(path)
+    if scale == 1: return image
+    if scale not in (2, 4, 8): raise ValueError('Images can only be scaled by 1, 2, 4 or 8.')
+
+    size = -(-image.size[0] // scale), -(-image.size[1] // scale)
+    image.draft(image.mode, size)
+    if image.size != size:
+        if image.mode not in _arrayModes: image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        image = image.resize(size, Image.BOX)
+    image.load()
+    return image
+
+
+# The cache shared by the whole process.
+cache = ImageCache()
+
+
+def load(path, scale=1):
+    """
+    Calls load on the shared cache.
+    """
+    return cache.load(path, scale)
+
+
+def read(path, scale=1):
+    """
+    Reads an image the way load does, but without caching it, for images that are only read
+    once. Palette and other modes are converted to RGB or RGBA.
+    """
+    if not isinstance(path, basestring) or path.lower().endswith('.npy'): return cache.load(path, scale)
+    return _loadMemory(_open(path, scale), 1)
+
+
+def array(path, bgr=False, scale=1):
+    """
+    Calls array on the shared cache.
+    """
+    return cache.array(path, bgr, scale)
+
+
+def image(path, scale=1):
+    """
+    Calls image on the shared cache.
+    """
+    return cache.image(path, scale)
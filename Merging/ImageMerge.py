@@ -1,6 +1,14 @@
-from PIL import Image
+import multiprocessing
+import time
 
+import numpy
+from PIL import Image, ImageDraw
+
+import BackgroundModel
+import CropSearch
+import ImageCache
 import PixelProcess
+import StreamMerge
 
 debug = 0
 
@@ -25,24 +33,55 @@ class Merger:
 
         self.initialized = 0
         self.autoSave = 0
+        # Above one, block merges are split into tiles of rows merged by a pool of processes.
+        self.processes = 1
+        # A sink, any callable taking a dictionary, given the timings and sizes of each merge and
+        # save. The Metrics module has sinks for JSON lines files and logging.
+        self.metrics = None
+        # Above one, merges check squares of this many pixels first and only merge the tiles of
+        # pyramidTile pixels within pyramidMargin pixels of squares that could hold a change.
+        self.pyramid = 1
+        self.pyramidTile = 32
+        self.pyramidMargin = 8
+        self._pyramidRange = None
+        # 2, 4 or 8 reads every image at that fraction of its size. The tracked image, regions
+        # and changed pixels are then in reduced pixels, see GroupContainer.rescale.
+        self.scale = 1
+        # An ImageWriter makes save, and so autosave, write files on a background thread.
+        self.writer = None
+        # Skip merging images identical to the tracked image, when the check command allows.
+        self.skipIdentical = 1
+        # Above zero, skip merges where none of this many evenly spread pixels pass the check.
+        self.sample = 0
+        # A BackgroundModel for mergeFrame to merge frames onto.
+        self.background = None
+        self._source = None
 
         self.outfile = outfile
 
         self.processor = PixelProcess.PixelRemote()
         self.mergedFiles = []
+        self.snapshots = []
+        self.regions = []
+        self._regionBlocks = None
 
-    def setup(self, file):
+    def setup(self, file, scaled=False):
         """
         `Author`: Bill Clark
 
         This method is called if a merge is activated and no prior merges have been done. It sets the image to
         be merged as the output result, as nothing cannot be merged with an image object. This method is
         internal and does not need to be called by a user. It is called if necessary from the merge methods.
+        The image is a copy of the shared ImageCache's, so decoding is skipped if it was read before.
+
+        `file`: A path to an image, or an image in memory, to initialize the Merge with.
 
-        `file`: A path to an image to initialize the Merge with.
+        `scaled`: True if an image in memory is already at the merger's scale.
         """
-        self.outimage = Image.open(file)
+        self.outimage = ImageCache.image(file, 1 if scaled else self.scale)
         self.processor.outdata = self.outimage.load()
+        self._source = ImageCache.fileKey(file) if isinstance(file, basestring) else None
+        self._pyramidRange = None
         if self.autoSave: self.save()
         self.initialized = 1
 
@@ -56,7 +95,7 @@ class Merger:
         actual pixel processing.
         When debug is enabled, merge prints the percentage of different and same pixels.
 
-        `images`: Any number of image paths to merge together.
+        `images`: Any number of image paths or images in memory to merge together.
         """
 
         if not self.initialized:
@@ -73,6 +112,41 @@ class Merger:
 
         if self.autoSave: self.save()
         
+    def mergeFrame(self, frame):
+        """
+        Merges a frame onto the background model's current background, then adds the frame to
+        the model. The tracked image becomes the background with this frame's changes acted on,
+        and an ExtractPixelRemote's changed pixels are replaced by this frame's. The first frame
+        only starts the model, nothing is merged.
+        Snapshots don't carry across frames, as each frame starts from a fresh background.
+
+        `frame`: Path of the frame, or a frame in memory.
+
+        `return`: The number of changed pixels.
+        """
+        if self.background is None: self.background = BackgroundModel.BackgroundModel()
+        comparearray, mode = ImageCache.load(frame, self.scale)
+        # The background is built from frames already read at the merger's scale, so neither
+        # it nor the frame is shrunk again.
+        if self.background.state is None:
+            self.background.update(comparearray)
+            self.setup(self.background.image(), scaled=True)
+            return 0
+
+        self.setup(self.background.image(), scaled=True)
+        if isinstance(self.processor, PixelProcess.ExtractPixelRemote):
+            self.processor.pixels = PixelProcess.ChangedPixels()
+        counter = self.checkAndAct(comparearray, scaled=True)
+
+        mask = None
+        if self.background.selective and counter and isinstance(self.processor, PixelProcess.ExtractPixelRemote):
+            changed = self.processor.pixels.mask()
+            mask = numpy.zeros(comparearray.shape[:2], bool)
+            mask[:changed.shape[0], :changed.shape[1]] = changed
+        self.background.update(comparearray, mask)
+        if self.autoSave: self.save()
+        return counter
+
     def testMerge(self, *images):
         """
         `Author`: Bill Clark
@@ -100,26 +174,43 @@ class Merger:
         `outfile`: Where to set the new output path to.
         """
 
-        # Make a backup of the outimage if one has been initialized.
-        orig = None
-        if self.initialized: orig = self.outimage.copy()
+        # Record the pixels this merge overwrites, so they can be put back afterwards.
+        self.snapshot()
 
         # Saves the autosave state and merges.
         state = self.autoSave
         self.autoSave = 0
-        self.merge(*images)
-        self.autoSave = state
-
-        # If the outfile is None, show the image and continue. If an outfile exists, save the image instead.
-        if outfile is not None: self.save(self.outimage, outfile)
-        else:  self.show()
+        try:
+            self.merge(*images)
+
+            # If the outfile is None, show the image and continue. If an outfile exists, save the image instead.
+            if outfile is not None: self.save(self.outimage, outfile)
+            else:  self.show()
+        finally:
+            # Restore the status to before the last merge. If there was no image before, reset the object.
+            self.autoSave = state
+            self.undo()
+
+    def snapshot(self):
+        """
+        Marks an undo point. Until it is undone, merges record only the pixels they overwrite
+        in it, and undo puts those pixels back. Snapshots stack, so several can be taken and
+        undone newest first.
+        """
+        self.snapshots.append(PixelProcess.Snapshot(self.initialized))
 
-        # If the back up was made, restore the status to before the last merge. Else, reset the object.
-        if orig is not None:
-            self.outimage = orig
-            self.processor.outdata = self.outimage.load()
+    def undo(self):
+        """
+        Returns the image to how it was at the latest snapshot and removes that snapshot. If
+        no image had been merged when the snapshot was taken, the merger is reset instead.
+        """
+        snapshot = self.snapshots.pop()
+        self._source = None
+        self._pyramidRange = None
+        if not snapshot.initialized:
+            self.initialized = 0
         else:
-            self = Merger(self.outfile)
+            snapshot.restore(self.outimage)
 
     def mergeAs(self, outfile, *images):
         """
@@ -136,172 +227,395 @@ class Merger:
         self.outfile = outfile
         self.merge(*images)
 
-    def _tupleSub(self, t, tt):
+    def cropFind(self, outfile, smallImage):
         """
         `Author`: Bill Clark
 
-        Finds the difference of each RGB value in two pixels. The difference has to be
-        greater than 5 to fail.
+        Finds where a subimage of the tracked image fits in the tracked image.
+        This is done by comparing the sides of the outfile image with each
+        row of pixels in the tracked image. This acommodates for rotation. The match
+        is as close to exact as is practical. Saving and cropping images can sometimes
+        cause small differences such as 1 or or 2 values.
+        The search itself is done by CropSearch.findSides, which finds candidate rows
+        with FFT cross correlation before checking them pixel by pixel.
+        The if result not none section can be replaced later to change what is done
+        with the result.
 
-        `t`: The first pixel to compare.
+        `outfile`: path to save the merged crop to.
 
-        `tt`: The second to compare.
+        `smallImage`: A subimage of the tracked image.
 
-        `return`: False if the difference between any RGB is greater than 5, else true.
+        `return`: None if no match is found, the result is one is.
         """
-        for one, two in zip(t, tt):
-            if abs(one - two) > 5:
-                return False
-        return True
+        smim = ImageCache.image(smallImage)
+        small = ImageCache.array(smallImage)
+
+        # Top, right, bottom and left sides, each read clockwise.
+        sides = small[0], small[:, -1], small[-1, ::-1], small[::-1, 0]
+        result = CropSearch.findSides(numpy.asarray(self.outimage), sides)
 
-    def _rowSizer(self, x, y, row, length):
+        if result is not None:
+            im = Image.new("RGBA", (self.outimage.size[0], self.outimage.size[0]))
+            im.paste(smim.convert("RGBA"), result[:2])
+            im.save(outfile)
+        self.exportMerge(outfile, outfile)
+        return result
+
+    def setRegions(self, *regions):
         """
-        `Author`: Bill Clark
+        Limits the following merges to regions of interest. Pixels outside every region are
+        neither compared nor changed, and images that can be memory mapped are only read inside
+        the regions. Regions may overlap, a pixel in several is still merged once. Region merges
+        take precedence over the pyramid and run in this process whatever processes is set to.
+        Calling this with no regions merges whole images again.
+
+        `regions`: Any number of rectangles, given as (left, top, right, bottom) with the right
+        and bottom edges excluded like a PIL box, or polygons, given as a list of (x, y) points.
+        """
+        self.regions = list(regions)
+        self._regionBlocks = None
 
-        This method take a row and makes the length equal to the length parameter. It fills
-        the row using the tracked image pixel data, building a row on y value Y starting at
-        x in that row. Supports shrinking a row as well, though that isn't needed anymore.
+    def regionBlocks(self):
+        """
+        Works out the area of the tracked image each region covers. Each region becomes a box
+        clipped to the image and, unless every pixel of the box is merged, a mask of the pixels
+        in it to merge. Pixels already covered by an earlier region are left out of the mask.
+        The result is kept until the regions or the image size change.
 
-        `x`: X value to start the row on.
+        `return`: A list of ((left, top, right, bottom), mask or None).
+        """
+        width, height = self.outimage.size
+        if self._regionBlocks is not None and self._regionBlocks[0] == (width, height):
+            return self._regionBlocks[1]
+
+        blocks = []
+        for region in self.regions:
+            if len(region) == 4 and numpy.ndim(region) == 1:
+                left, top, right, bottom = [int(value) for value in region]
+                mask = None
+            else:
+                xs, ys = zip(*region)
+                left, top = int(numpy.floor(min(xs))), int(numpy.floor(min(ys)))
+                right, bottom = int(numpy.ceil(max(xs))) + 1, int(numpy.ceil(max(ys))) + 1
+                drawing = Image.new('L', (right - left, bottom - top))
+                ImageDraw.Draw(drawing).polygon([(x - left, y - top) for x, y in region], fill=1)
+                mask = numpy.array(drawing, bool)
+            box = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+            if box[0] >= box[2] or box[1] >= box[3]: continue
+            if mask is not None:
+                mask = mask[box[1] - top:box[3] - top, box[0] - left:box[2] - left]
+
+            for other, othermask in blocks:
+                overlap = max(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), min(box[3], other[3])
+                if overlap[0] >= overlap[2] or overlap[1] >= overlap[3]: continue
+                if mask is None: mask = numpy.ones((box[3] - box[1], box[2] - box[0]), bool)
+                covered = numpy.ones((overlap[3] - overlap[1], overlap[2] - overlap[0]), bool)
+                if othermask is not None:
+                    covered = othermask[overlap[1] - other[1]:overlap[3] - other[1], overlap[0] - other[0]:overlap[2] - other[0]]
+                mask[overlap[1] - box[1]:overlap[3] - box[1], overlap[0] - box[0]:overlap[2] - box[0]] &= ~covered
+            blocks.append((box, mask))
+
+        self._regionBlocks = (width, height), blocks
+        return blocks
+
+    def sweep(self, img, thresholds, connectivity=4, top=None):
+        """
+        Shows what merging an image with a ColorDiffCommand would find at several diffnums,
+        without merging it. The image is compared against the tracked image once, see the
+        module's sweep function for the results.
 
-        `y`: Y value of the row.
+        `img`: Path of the image to compare against the tracked image.
 
-        `row`: The array that will hold the row.
+        `thresholds`: The diffnums to group the changed pixels of.
 
-        `length`: required length of the row.
+        `connectivity`: 4 to join pixels that share a side, 8 to also join diagonals.
 
-        `return`: The new row.
+        `top`: If given, only the largest groups up to this many are kept per threshold.
+
+        `return`: The difference histogram, and (threshold, changed count, groups) per threshold.
         """
-        while len(row) != length: #get the row to match the size.
-            if len(row) > length:
-                del row[-1]
-            elif len(row) < length:
-               row.append(self.processor.outdata[x+len(row),y])
-        return row
+        return _sweepArrays(numpy.asarray(self.outimage), self.outimage.mode, img, thresholds, connectivity, top,
+                            self.scale)
 
-    def _compareRow(self, sideOne, sideTwo, row):
+    def checkAndAct(self, img, scaled=False):
         """
         `Author`: Bill Clark
 
-        Compares two rows to another. This is used to compare the top and bottom, as well as the
-        left and right rows of the subimage to an equally sized row from the tracked image.
-        The comparison is done via tuplesub, this controls the pixel flow into that function.
+        The primary action method. This method takes an image and merges it onto the output data stored
+        in the class. For every pixel in each image, the class's pixelChecker is used to compare them.
+        If the check returns true, the class's pixelActor is called to act on the pixels. For every acted on
+        pixel pair, the method's counter is increased. This count is returned as a statistic.
+        When the commands have array forms the whole image is processed as one numpy block.
+        While skipIdentical is set and the check command promises identical pixels are never acted
+        on, an image identical to the tracked image is skipped. The file the tracked image was read
+        from, or last matched, is skipped before it is even decoded, other images are compared band
+        by band. A sample above zero also skips images where none of the sampled pixels pass the
+        check, which misses changes that fall between the samples.
 
-        `sideOne`: The top or right side to be compared.
+        `img`: An image file, or an image in memory, to be merged onto the class's image. A PIL
+        image, a numpy array or an ImageCache.BGR wrapped array from cv2 can be given, and arrays
+        are compared without copying.
 
-        `sideTwo`: The bottom or left side to be compared.
+        `scaled`: True if an image in memory is already at the merger's scale.
 
-        `row`: The row to compare to from the tracked image.
+        `return`: The number of modified pixels.
+        """
+        scale = 1 if scaled else self.scale
+        start = time.time()
+        identical = self.skipIdentical and self.processor.checkcmd.ignoresIdentical()
+        key = ImageCache.fileKey(img) if identical and isinstance(img, basestring) else None
+        comparearray, mode = None, None
+        if key is None or key != self._source:
+            if self.regions and self.scale == 1 and isinstance(img, basestring):
+                comparearray = StreamMerge.mapImage(img)
+            if comparearray is not None and comparearray.ndim == 3 and comparearray.shape[2] in (3, 4):
+                mode = ('RGB', 'RGBA')[comparearray.shape[2] - 3]
+            else:
+                comparearray, mode = ImageCache.load(img, scale)
+        decode = time.time() - start
+
+        self.processor.journal = self.snapshots[-1] if self.snapshots else None
+        self.processor.stats = {'compare': 0.0, 'act': 0.0, 'bytes': 0}
+        start = time.time()
+        if comparearray is None:
+            counter, engine = 0, 'identical'
+        elif identical and self._samePixels(comparearray, mode):
+            self._source = key
+            counter, engine = 0, 'identical'
+        elif self.sample > 0 and self._canRunBlock(comparearray, mode) and self._sampleUnchanged(comparearray):
+            counter, engine = 0, 'sampled'
+        elif self._canRunBlock(comparearray, mode):
+            if self.regions:
+                counter = self._checkAndActRegions(comparearray)
+                engine = 'region'
+            elif self.pyramid > 1 and self.processor.checkcmd.hasBound():
+                counter = self._checkAndActPyramid(comparearray)
+                engine = 'pyramid'
+            else:
+                counter = self._checkAndActBlock(comparearray)
+                engine = 'parallel' if self.processes > 1 else 'block'
+        else:
+            start = time.time()
+            self.processor.comparedata = ImageCache.image(img, scale).load()
+
+            counter = 0
+            if self.regions:
+                for (left, top, right, bottom), mask in self.regionBlocks():
+                    for y in range(top, bottom):
+                        for x in range(left, right):
+                            if mask is None or mask[y - top, x - left]:
+                                counter += self.processor.run(x, y, x, y)
+            else:
+                for y in range(self.outimage.size[1]):
+                    for x in range(self.outimage.size[0]):
+                        counter += self.processor.run(x, y, x, y)
+            self.processor.stats.update(compare=time.time() - start, act=None)
+            engine = 'pixel'
+        if engine in ('identical', 'sampled'): self.processor.stats.update(compare=time.time() - start, act=None)
+        if counter: self._source = None
+        if counter and engine != 'pyramid': self._pyramidRange = None
+
+        stats, self.processor.stats = self.processor.stats, None
+        if self.metrics is not None:
+            width, height = self.outimage.size
+            if not isinstance(img, basestring): img = type(img).__name__
+            stats.update(event='merge', image=img, engine=engine, decode=decode, width=width, height=height,
+                         pixels=width * height, changed=counter, ratio=counter / float(width * height))
+            self.metrics(stats)
+        return counter
 
-        `return`: Flag (True if a match was found), if1 (sideOne is same or not), & if2 (same for sideTwo)
+    def _samePixels(self, comparearray, mode):
         """
-        flag, if1, if2 = True, True, True
-        for side1, side2, lg in zip(sideOne, sideTwo, row):
-            if if1: if1 = self._tupleSub(side1, lg)
-            if if2: if2 = self._tupleSub(side2, lg)
+        Checks if an image matches the tracked image exactly, over the tracked image's area.
+        The images are compared in bands of about a megabyte, so an image that differs near
+        the top is rejected after reading very little of it.
 
-            if not if1 and not if2:
-                flag = False
-                break
-        return flag, if1, if2
+        `comparearray`: The pixels of the image to be merged.
 
-    def cropFind(self, outfile, smallImage):
+        `mode`: The mode of the image to be merged.
+
+        `return`: True if every pixel is the same.
         """
-        `Author`: Bill Clark
+        width, height = self.outimage.size
+        if mode != self.outimage.mode or mode not in ('L', 'RGB', 'RGBA') \
+                or comparearray.shape[0] < height or comparearray.shape[1] < width:
+            return False
+        rows = max(1, 2**20 // (width * len(mode)))
+        for top in xrange(0, height, rows):
+            bottom = min(top + rows, height)
+            band = numpy.asarray(self.outimage.crop((0, top, width, bottom)))
+            if not numpy.array_equal(band, comparearray[top:bottom, :width]): return False
+        return True
 
-        Finds where a subimage of the tracked image fits in the tracked image.
-        This is done by comparing the sides of the outfile image with each
-        row of pixels in the tracked image. This acommodates for rotation. The match
-        is as close to exact as is practical. Saving and cropping images can sometimes
-        cause small differences such as 1 or or 2 values.
-        The if result not none section can be replaced later to change what is done
-        with the result.
+    def _sampleUnchanged(self, comparearray):
+        """
+        Runs the check command on sample pixels, spread evenly in raster order over the
+        tracked image.
 
-        `outfile`: path to save the merged crop to.
+        `comparearray`: The pixels of the image to be merged.
 
-        `smallImage`: A subimage of the tracked image.
+        `return`: True if none of the samples pass the check.
+        """
+        width, height = self.outimage.size
+        index = numpy.linspace(0, width * height - 1, min(self.sample, width * height)).astype(numpy.int64)
+        ys, xs = index // width, index % width
+        outdata = self.processor.outdata
+        samples = numpy.array([outdata[x, y] for x, y in zip(xs.tolist(), ys.tolist())], numpy.uint8)
+        return not self.processor.checkcmd.executeBlock(samples, comparearray[ys, xs]).any()
+
+    def _canRunBlock(self, comparearray, mode):
+        """
+        Decides if a merge can be done on whole arrays instead of pixel by pixel. The remote's
+        commands must have array forms, and both images must be RGB or RGBA in the same mode.
+        The compare image has to cover the tracked image, otherwise the pixel loop is left to
+        fail as it always has.
 
-        `return`: None if no match is found, the result is one is.
+        `comparearray`: The pixels of the image to be merged.
+
+        `mode`: The mode of the image to be merged.
+
+        `return`: True if _checkAndActBlock can be used.
         """
-        smim = Image.open(smallImage)
-        smdata = smim.load()
-        xlen, ylen = smim.size
-        result = None 
-
-        sides = [[], [], [], []]
-
-        high = max(xlen, ylen)
-        for i in xrange(high):
-            if i < xlen:
-                sides[0].append(smdata[(i, 0)])
-                sides[2].append(smdata[((xlen-1)-i, ylen-1)])
-            if i < ylen:
-                sides[1].append(smdata[(xlen-1, i)])
-                sides[3].append(smdata[(0, (ylen-1)-i)])
-        for side in sides:
-            side = tuple(side)
-        sides = tuple(sides)
-
-        for y in range(self.outimage.size[1]):
-            row1 = self._rowSizer(0,y,[],xlen-1)
-            row2 = self._rowSizer(0,y,[],ylen-1)
-            for x in range(self.outimage.size[0]):
-                if result is not None:
-                    break
-
-                if (x + xlen) <= self.outimage.size[0]: #Top and Bottom check.
-
-                    row1.append(self.processor.outdata[x+len(row1),y])
-                    flag, if0, if2 = self._compareRow(sides[0], sides[2], row1)
-
-                    if flag and if0: result = x, y, 0
-                    if flag and if2: result = x, y, 2
-
-                if (x + ylen) <= self.outimage.size[0]:
-
-                    row2.append(self.processor.outdata[x+len(row2),y])
-                    flag, if1, if3 = self._compareRow(sides[1], sides[3], row2)
-
-                    if flag and if1: result = x, y, 1
-                    if flag and if3: result = x, y, 3
-                del row1[0]
-                del row2[0]
-        if result is not None:
-            im = Image.new("RGBA", (self.outimage.size[0], self.outimage.size[0]))
-            imdata = im.load()
+        width, height = self.outimage.size
+        return self.processor.canRunBlock() \
+            and self.outimage.mode in ('RGB', 'RGBA') \
+            and mode == self.outimage.mode \
+            and comparearray.shape[1] >= width and comparearray.shape[0] >= height
 
-            for y in range(smim.size[1]):
-                for x in range(smim.size[0]):
-                    newx = result[0] + x
-                    newy = result[1] + y
-                    imdata[newx, newy] = smdata[x,y]
+    def _checkAndActBlock(self, comparearray):
+        """
+        The array version of checkAndAct. Both images are loaded as numpy arrays and handed
+        to the remote in one block, so the check and act commands run once per merge rather
+        than once per pixel. The result is pasted back onto the tracked image.
 
-            im.save(outfile)
-        self.exportMerge(outfile, outfile)
-        return result
+        `comparearray`: The pixels of the image to be merged.
 
-    def checkAndAct(self, img):
+        `return`: The number of modified pixels.
         """
-        `Author`: Bill Clark
+        width, height = self.outimage.size
+        comparearray = comparearray[:height, :width]
 
-        The primary action method. This method takes an image and merges it onto the output data stored
-        in the class. For every pixel in each image, the class's pixelChecker is used to compare them.
-        If the check returns true, the class's pixelActor is called to act on the pixels. For every acted on
-        pixel pair, the method's counter is increased. This count is returned as a statistic.
+        if self.processes > 1:
+            outarray, counter = self._runParallel(comparearray)
+        else:
+            outarray = numpy.array(self.outimage)
+            counter = self.processor.runBlock(outarray, comparearray)
+
+        if counter: self.outimage.paste(Image.fromarray(outarray, self.outimage.mode))
+        self.processor.stats['bytes'] += outarray.nbytes * (2 if self.processes > 1 else 1)
+        return counter
 
-        `img`: An image file to be merged onto the class's image.
+    def _checkAndActRegions(self, comparearray):
+        """
+        The array version of checkAndAct for region merges. Each region's box is cut from
+        both images and merged as its own block, then pasted back onto the tracked image.
+
+        `comparearray`: The pixels of the image to be merged.
+
+        `return`: The number of modified pixels.
+        """
+        counter = 0
+        for box, mask in self.regionBlocks():
+            left, top, right, bottom = box
+            outarray = numpy.array(self.outimage.crop(box))
+            count = self.processor.runBlock(outarray, comparearray[top:bottom, left:right], left, top, mask)
+            if count: self.outimage.paste(Image.fromarray(outarray, self.outimage.mode), box[:2])
+            self.processor.stats['bytes'] += outarray.nbytes
+            counter += count
+        return counter
+
+    def _checkAndActPyramid(self, comparearray):
+        """
+        The array version of checkAndAct for pyramid merges. Both images are reduced to the
+        highest and lowest values of each square, and the check command's bound flags the
+        squares that could hold a change. These are grown by the margin and mapped onto a grid
+        of tiles, and each row of tiles is merged at full size in runs of flagged tiles.
+        The tracked image's squares are kept between pyramid merges, and only the squares of
+        merged tiles are worked out again, so each merge reduces just the image merged in.
+
+        `comparearray`: The pixels of the image to be merged.
 
         `return`: The number of modified pixels.
         """
-        compareimage = Image.open(img)
-        self.processor.comparedata = compareimage.load()
+        width, height = self.outimage.size
+        factor = self.pyramid
+        tile = -(-self.pyramidTile // factor) * factor
+        size = -(-width // factor), -(-height // factor)
+
+        start = time.time()
+        if self._pyramidRange is None or self._pyramidRange[0] != factor \
+                or self._pyramidRange[1].shape[:2] != (size[1], size[0]):
+            self._pyramidRange = (factor,) + _blockRange(numpy.asarray(self.outimage), factor)
+        high1, low1 = self._pyramidRange[1:]
+        high2, low2 = _blockRange(comparearray[:height, :width], factor)
+        coarse = self.processor.checkcmd.boundBlock(high1, low1, high2, low2)
+        coarse = PixelProcess.dilateMask(coarse, 2 * -(-self.pyramidMargin // factor) + 1)
+
+        step = tile // factor
+        rows, columns = -(-size[1] // step), -(-size[0] // step)
+        padded = numpy.zeros((rows * step, columns * step), bool)
+        padded[:size[1], :size[0]] = coarse
+        tiles = padded.reshape(rows, step, columns, step).any(axis=3).any(axis=1)
+        self.processor.stats['compare'] += time.time() - start
+        self.processor.stats['bytes'] += 2 * high1.nbytes
 
         counter = 0
-        for y in range(self.outimage.size[1]):
-            for x in range(self.outimage.size[0]):
-                counter += self.processor.run(x, y, x, y)
+        for row in numpy.flatnonzero(tiles.any(axis=1)):
+            edges = numpy.diff(numpy.concatenate(([0], tiles[row].view(numpy.int8), [0])))
+            for first, last in zip(numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)):
+                box = first * tile, row * tile, min(last * tile, width), min((row + 1) * tile, height)
+                outarray = numpy.array(self.outimage.crop(box))
+                count = self.processor.runBlock(outarray, comparearray[box[1]:box[3], box[0]:box[2]], box[0], box[1])
+                if count:
+                    self.outimage.paste(Image.fromarray(outarray, self.outimage.mode), box[:2])
+                    squares = slice(box[1] // factor, -(-box[3] // factor)), slice(box[0] // factor, -(-box[2] // factor))
+                    high1[squares], low1[squares] = _blockRange(outarray, factor)
+                self.processor.stats['bytes'] += outarray.nbytes
+                counter += count
         return counter
 
+    def _runParallel(self, comparearray):
+        """
+        Runs a block merge across a pool of processes. Both images are copied into shared
+        memory once, which the workers map instead of being sent pixel data. The rows are
+        split into tiles, several per process, and each worker merges its tiles in place.
+        The workers send back only their changed counts and, for an ExtractPixelRemote,
+        the changed pixels, which are recorded the same as a serial merge would. Overwritten
+        pixels are sent back too when a snapshot is recording.
+
+        `comparearray`: The image to be merged, cropped to the tracked image's size.
+
+        `return`: The merged array and the number of modified pixels.
+        """
+        shape = comparearray.shape
+        outbuffer = multiprocessing.RawArray('B', comparearray.size)
+        comparebuffer = multiprocessing.RawArray('B', comparearray.size)
+        outarray = numpy.frombuffer(outbuffer, numpy.uint8).reshape(shape)
+        outarray[...] = numpy.asarray(self.outimage)
+        numpy.frombuffer(comparebuffer, numpy.uint8).reshape(shape)[...] = comparearray
+
+        record = isinstance(self.processor, PixelProcess.ExtractPixelRemote)
+        journal = self.processor.journal is not None
+        rows = -(-shape[0] // (self.processes * 4))
+        tiles = [(top, top + rows) for top in xrange(0, shape[0], rows)]
+
+        pool = multiprocessing.Pool(self.processes, _initTileWorker, (outbuffer, comparebuffer, shape,
+                                    self.processor.checkcmd, self.processor.actcmd, record, journal))
+        try:
+            results = pool.map(_mergeTile, tiles)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        counter = 0
+        for count, xs, ys, values, snapshot, stats in results:
+            counter += count
+            if record: self.processor.recordBlock(xs, ys, values)
+            if journal: self.processor.journal.extend(snapshot)
+            if self.processor.stats is not None:
+                for key in stats: self.processor.stats[key] += stats[key]
+        return outarray, counter
+
     def convert(self, *images):
         """
         `Author`: Bill Clark
@@ -344,7 +658,8 @@ class Merger:
         `Author`: Bill Clark
 
         Saves an image to disk. The image can be specified, other wise the class's image is defaulted to.
-        The outfile can also be optionally specified.
+        The outfile can also be optionally specified. With a writer set the save is queued, so call
+        flush before reading the outfile back.
 
         `image`: Defaults to the class's image unless specified. The image to be saved.
 
@@ -352,7 +667,19 @@ class Merger:
         """
         if not image: image = self.outimage
         if not outfile: outfile = self.outfile
+        if self.writer is not None:
+            self.writer.save(image, outfile, self.metrics)
+            return
+        start = time.time()
         image.save(outfile)
+        if self.metrics is not None:
+            self.metrics({'event': 'save', 'outfile': outfile, 'seconds': time.time() - start})
+
+    def flush(self):
+        """
+        Waits for saves made through the writer to be written. Does nothing without a writer.
+        """
+        if self.writer is not None: self.writer.flush()
 
     def printDiffSame(self, counter):
         """
@@ -362,8 +689,220 @@ class Merger:
 
         `counter`: The count of changed pixels in a merge operation. Obtained from checkandact.
         """
-        print "Different Pixels:", counter, repr(round((counter/360000.)*100,2)) + '%', " Same Pixels:", \
-            360000-counter, repr(round(((360000-counter)/360000.)*100,2)) + '%'+ '\n'
+        total = float(self.outimage.size[0] * self.outimage.size[1])
+        print "Different Pixels:", counter, repr(round((counter/total)*100,2)) + '%', " Same Pixels:", \
+            int(total)-counter, repr(round(((total-counter)/total)*100,2)) + '%'+ '\n'
+
+
+def _blockRange(data, factor):
+    """
+    Reduces an image to the highest and lowest values of each square of factor pixels, per
+    channel. Squares cut off by the edge use the pixels they have. Each pass takes one row
+    or column of every square, so the work is whole rows of pixels and nothing is padded.
+
+    `data`: The pixels, channels last.
+
+    `factor`: The size of the squares.
+
+    `return`: The highest and lowest arrays, each of shape (rows, columns, channels).
+    """
+    high, low = data[::factor].copy(), data[::factor].copy()
+    for offset in range(1, factor):
+        band = data[offset::factor]
+        numpy.maximum(high[:len(band)], band, high[:len(band)])
+        numpy.minimum(low[:len(band)], band, low[:len(band)])
+
+    squarehigh, squarelow = high[:, ::factor].copy(), low[:, ::factor].copy()
+    for offset in range(1, factor):
+        count = high[:, offset::factor].shape[1]
+        numpy.maximum(squarehigh[:, :count], high[:, offset::factor], squarehigh[:, :count])
+        numpy.minimum(squarelow[:, :count], low[:, offset::factor], squarelow[:, :count])
+    return squarehigh, squarelow
+
+
+def batchMerge(base, candidates, checkcmd=None, processes=None, connectivity=4, top=None):
+    """
+    Compares one base image against many candidate images. Each candidate is compared to
+    the base on its own, not merged on top of the candidates before it. The base is decoded
+    once and copied into shared memory, and a pool of processes works through the
+    candidates, decoding and comparing each one and grouping its changed pixels. Candidates
+    are read without going through the image cache, as each is only read once.
+    Results are yielded in the order the candidates were given, as soon as each is ready.
+    The base must be RGB or RGBA. A candidate that can't be read or doesn't match the base
+    in mode and size gives its error in place of a count and groups, and the batch carries on.
+
+    `base`: Path of the reference image.
+
+    `candidates`: Any iterable of image paths to compare against the base.
+
+    `checkcmd`: The check command deciding which pixels changed. Defaults to a ColorDiffCommand.
+
+    `processes`: The number of worker processes. Defaults to one per core, one runs in
+    this process.
+
+    `connectivity`: 4 to join pixels that share a side, 8 to also join diagonals.
+
+    `top`: If given, only the largest groups up to this many are kept per candidate.
+
+    `yield`: (candidate, changed pixel count, group container sorted by count), or
+    (candidate, None, the error raised) for a candidate that failed.
+    """
+    if checkcmd is None: checkcmd = PixelProcess.ColorDiffCommand()
+    basearray, mode = ImageCache.load(base)
+    if mode not in ('RGB', 'RGBA'): raise ValueError('%s must be RGB or RGBA.' % base)
+
+    if processes == 1:
+        for candidate in candidates:
+            yield _compareCandidate(basearray, mode, checkcmd, connectivity, top, candidate)
+        return
+
+    buffer = multiprocessing.RawArray('B', basearray.size)
+    numpy.frombuffer(buffer, numpy.uint8).reshape(basearray.shape)[...] = basearray
+    pool = multiprocessing.Pool(processes, _initBatchWorker,
+                                (buffer, basearray.shape, mode, checkcmd, connectivity, top))
+    try:
+        for result in pool.imap(_compareBatchCandidate, candidates):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def sweep(base, image, thresholds, connectivity=4, top=None, scale=1):
+    """
+    Compares two images at many ColorDiffCommand diffnums in one pass. The largest channel
+    difference of each pixel is worked out once. A histogram of those differences gives the
+    changed count for any diffnum straight away, as the pixels counted at diffnum t are those
+    in the histogram above t. The changed pixels at each requested threshold are also grouped.
+
+    `base`: Path of the reference image.
+
+    `image`: Path of the image to compare against it.
+
+    `thresholds`: The diffnums to group the changed pixels of.
+
+    `connectivity`: 4 to join pixels that share a side, 8 to also join diagonals.
+
+    `top`: If given, only the largest groups up to this many are kept per threshold.
+
+    `scale`: Compare the images at 1/2, 1/4 or 1/8 of their size. The groups are rescaled
+    to full size units, the histogram counts reduced size pixels.
+
+    `return`: A 256 long array counting the pixels at each difference, and a list of
+    (threshold, changed count, group container sorted by count) in the thresholds' order.
+    """
+    basearray, mode = ImageCache.load(base, scale)
+    return _sweepArrays(basearray, mode, image, thresholds, connectivity, top, scale)
+
+
+def _sweepArrays(basearray, mode, image, thresholds, connectivity, top, scale=1):
+    """
+    Does the work of sweep against an already loaded base.
+    """
+    height, width = basearray.shape[:2]
+    comparearray, comparemode = ImageCache.load(image, scale)
+    if mode not in ('RGB', 'RGBA') or comparemode not in ('RGB', 'RGBA') \
+            or comparearray.shape[0] < height or comparearray.shape[1] < width:
+        raise ValueError('%s must be RGB or RGBA and cover the base image.' % image)
+
+    difference = PixelProcess.ColorDiffCommand.differenceBlock(basearray, comparearray[:height, :width])
+    histogram = numpy.bincount(difference.ravel(), minlength=256)
+    above = numpy.append(histogram[::-1].cumsum()[::-1], 0)
+
+    results = []
+    for threshold in thresholds:
+        index = max(-1, min(int(threshold), 255))
+        groups = PixelProcess.groupMask(difference > index, connectivity)
+        if top is not None: groups.keepTop(top)
+        else: groups.sortCount()
+        if scale != 1: groups.rescale(scale)
+        results.append((threshold, int(above[index + 1]), groups))
+    return histogram, results
+
+
+def _compareCandidate(basearray, mode, checkcmd, connectivity, top, candidate):
+    """
+    Compares one candidate against the base for batchMerge.
+
+    `return`: The candidate, its changed pixel count and its groups, or the candidate, None
+    and the error if it failed.
+    """
+    height, width = basearray.shape[:2]
+    try:
+        comparearray, comparemode = ImageCache.read(candidate)
+        if comparemode != mode or comparearray.shape[0] < height or comparearray.shape[1] < width:
+            raise ValueError('%s does not match the base image in mode or size.' % candidate)
+    except (IOError, ValueError) as error:
+        return candidate, None, error
+    comparearray = comparearray[:height, :width]
+
+    if checkcmd.hasBlock():
+        mask = checkcmd.executeBlock(basearray, comparearray)
+    else:
+        baseimage = Image.fromarray(basearray, mode)
+        baseimage, compareimage = baseimage.load(), Image.fromarray(comparearray, mode).load()
+        mask = numpy.zeros((height, width), bool)
+        for y in xrange(height):
+            for x in xrange(width):
+                mask[y, x] = checkcmd.execute(baseimage[x, y], compareimage[x, y])
+
+    groups = PixelProcess.groupMask(mask, connectivity)
+    if top is not None: groups.keepTop(top)
+    else: groups.sortCount()
+    return candidate, int(numpy.count_nonzero(mask)), groups
+
+
+_batchState = None
+
+
+def _initBatchWorker(buffer, shape, mode, checkcmd, connectivity, top):
+    """
+    Sets up a worker process for batchMerge, wrapping the shared base image as an array.
+    """
+    global _batchState
+    _batchState = (numpy.frombuffer(buffer, numpy.uint8).reshape(shape), mode, checkcmd, connectivity, top)
+
+
+def _compareBatchCandidate(candidate):
+    """
+    Compares one candidate in a worker process.
+    """
+    return _compareCandidate(*(_batchState + (candidate,)))
+
+
+_tileState = None
+
+
+def _initTileWorker(outbuffer, comparebuffer, shape, checkcmd, actcmd, record, journal):
+    """
+    Sets up a worker process for Merger._runParallel. The shared buffers are wrapped as
+    arrays and a remote is built around the merger's commands.
+    """
+    global _tileState
+    processor = PixelProcess.PixelRemote()
+    processor.setCheckCommand(checkcmd)
+    processor.setActorCommand(actcmd)
+    _tileState = (numpy.frombuffer(outbuffer, numpy.uint8).reshape(shape),
+                  numpy.frombuffer(comparebuffer, numpy.uint8).reshape(shape), processor, record, journal)
+
+
+def _mergeTile(tile):
+    """
+    Merges one tile of rows in a worker process, writing into the shared output array.
+
+    `tile`: The first row and the row after the last.
+
+    `return`: The changed count, the X values, Y values and pixels changed if recording, a
+    snapshot of the overwritten pixels if journalling, and the tile's stats.
+    """
+    outarray, comparearray, processor, record, journal = _tileState
+    top, bottom = tile
+    if journal: processor.journal = PixelProcess.Snapshot()
+    processor.stats = {'compare': 0.0, 'act': 0.0, 'bytes': 0}
+    mask, values = processor._actBlock(outarray[top:bottom], comparearray[top:bottom], 0, top)
+    if not record: return len(values), None, None, None, processor.journal, processor.stats
+    ys, xs = numpy.nonzero(mask)
+    return len(values), xs, ys + top, values, processor.journal, processor.stats
 
 
 if __name__ == "__main__":
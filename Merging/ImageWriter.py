@@ -0,0 +1,108 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+
+class ImageWriter(object):
+
+    def __init__(self, maxsize=4):
+        """
+        Saves images on a background thread, so encoding and writing a file doesn't hold up
+        the next merge. Each save takes a copy of the image, which is much cheaper than
+        encoding it. Saves to an outfile that is still waiting are superseded: the waiting
+        copy is replaced by the newer one, so when merges arrive faster than files can be
+        written only the latest state of each outfile is encoded.
+        At most maxsize outfiles wait at once. A save to another outfile blocks until one
+        has been written. An error raised while writing is raised again by the next call to
+        save, flush or close. The writer is closed when the interpreter exits, so queued saves
+        are written before it stops.
+
+        `maxsize`: The most outfiles that may be waiting to be written.
+        """
+        self.maxsize = maxsize
+        self.pending = OrderedDict()
+        self.writing = None
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, image, outfile, metrics=None):
+        """
+        Queues an image to be saved, replacing any save to the same outfile that hasn't
+        started yet.
+
+        `image`: The PIL image to save. A copy is taken, so it may be changed straight away.
+
+        `outfile`: The path to save to.
+
+        `metrics`: An optional sink, given a save record once the file is written.
+        """
+        image = image.copy()
+        with self.condition:
+            self._raise()
+            if self.closed: raise ValueError('The writer is closed.')
+            while outfile not in self.pending and len(self.pending) >= self.maxsize:
+                self.condition.wait()
+                self._raise()
+            self.pending[outfile] = image, metrics
+            self.condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until every queued save has been written.
+        """
+        with self.condition:
+            while self.pending or self.writing is not None:
+                self.condition.wait()
+            self._raise()
+
+    def close(self):
+        """
+        Writes every queued save, then stops the background thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        with self.condition:
+            self._raise()
+
+    def _raise(self):
+        """
+        Raises the error from a failed write, if there was one. Called with the lock held.
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        """
+        The background thread. Writes the oldest queued outfile until closed and empty.
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending: return
+                outfile, (image, metrics) = self.pending.popitem(last=False)
+                self.writing = outfile
+                self.condition.notify_all()
+
+            try:
+                start = time.time()
+                image.save(outfile)
+                if metrics is not None:
+                    metrics({'event': 'save', 'outfile': outfile, 'seconds': time.time() - start})
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+
+            with self.condition:
+                self.writing = None
+                self.condition.notify_all()
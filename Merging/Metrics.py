@@ -0,0 +1,63 @@
+"""
+Sinks for the records a Merger emits when its metrics attribute is set. Any callable that
+takes one dictionary is a sink, so a plain function works as a callback. The records are:
+
+merge: one per image merged, with the image path, the image's width, height and pixels,
+    the changed pixel count and its ratio to the pixel count, the engine used (block,
+    parallel, region, pyramid or pixel, or identical or sampled for skipped merges), the
+    seconds spent decoding, comparing and acting, and the bytes of arrays the merge
+    allocated. Parallel merges report compare and act time summed over the workers. The
+    pixel loop and skipped merges can't separate acting from comparing, so their act is
+    None.
+save: one per save, with the outfile and the seconds spent encoding and writing it.
+"""
+
+import json
+import logging
+
+
+class JsonLinesSink(object):
+
+    def __init__(self, path):
+        """
+        A sink that appends each record to a file as one line of JSON.
+
+        `path`: The file to append to.
+        """
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class LoggingSink(object):
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        A sink that logs each record as JSON through the logging module.
+
+        `logger`: The logger to use. Defaults to the Merging logger.
+
+        `level`: The level to log at.
+        """
+        self.logger = logger if logger is not None else logging.getLogger('Merging')
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, json.dumps(record, sort_keys=True))
+
+
+class MultiSink(object):
+
+    def __init__(self, *sinks):
+        """
+        A sink that passes each record on to several others.
+
+        `sinks`: Any number of sinks.
+        """
+        self.sinks = sinks
+
+    def __call__(self, record):
+        for sink in self.sinks:
+            sink(record)
@@ -0,0 +1,203 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+
+import numpy
+
+import ImageCache
+import PixelProcess
+
+# Where the console keeps its store unless told otherwise.
+defaultPath = 'Output/results.db'
+
+# Content hashes of files already read, by ImageCache.fileKey.
+_hashes = {}
+
+
+class ResultStore(object):
+
+    def __init__(self, path=defaultPath, budget=256 * 2**20):
+        """
+        A store of group results kept on disk in an sqlite database, so analysing the same
+        pair of images again reads the groups back instead of merging. Results are keyed by
+        content hashes of both images and a description of how they were merged, so a
+        renamed copy of an image finds the same result and an edited one doesn't. Each group
+        is stored as its bounding box and a bit packed mask of its pixels.
+        Once the stored results take more than the budget, the least recently used are
+        dropped.
+
+        `path`: The database file. Its directory is made if needed.
+
+        `budget`: The most bytes of results to keep.
+        """
+        self.path = path
+        self.budget = budget
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory): os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, base TEXT, image TEXT, '
+                        'used REAL, size INTEGER, data BLOB)')
+        self.db.commit()
+
+    def key(self, base, image, *config):
+        """
+        Builds the key for a pair of images merged a certain way.
+
+        `base`: Path of the first image, or an image in memory.
+
+        `image`: Path of the image merged onto it, or an image in memory.
+
+        `config`: Anything else the result depends on, as JSON compatible values. See
+        mergeConfig for a merger's commands and settings.
+
+        `return`: The key, a tuple of the two content hashes and a config digest.
+        """
+        config = json.dumps(config, sort_keys=True)
+        return contentHash(base), contentHash(image), hashlib.sha1(config).hexdigest()
+
+    def get(self, key):
+        """
+        Reads a stored result.
+
+        `key`: A key from the key method.
+
+        `return`: A group container, or None if nothing is stored under the key.
+        """
+        row = self.db.execute('SELECT data FROM results WHERE key = ?', ('/'.join(key),)).fetchone()
+        if row is None: return None
+        self.db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), '/'.join(key)))
+        self.db.commit()
+        return _unpack(str(row[0]))
+
+    def put(self, key, groups):
+        """
+        Stores a result, then drops the least recently used results until the store fits
+        its budget.
+
+        `key`: A key from the key method.
+
+        `groups`: The group container to store.
+        """
+        data = _pack(groups)
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                        ('/'.join(key), key[0], key[1], time.time(), len(data), buffer(data)))
+        total = self.db.execute('SELECT SUM(size) FROM results').fetchone()[0]
+        for name, size in self.db.execute('SELECT key, size FROM results ORDER BY used').fetchall():
+            if total <= self.budget: break
+            self.db.execute('DELETE FROM results WHERE key = ?', (name,))
+            total -= size
+        self.db.commit()
+
+    def invalidate(self, image=None):
+        """
+        Drops stored results.
+
+        `image`: Drop every result the current contents of this image were part of. If
+        None, drop everything.
+        """
+        if image is None:
+            self.db.execute('DELETE FROM results')
+        else:
+            digest = contentHash(image)
+            self.db.execute('DELETE FROM results WHERE base = ? OR image = ?', (digest, digest))
+        self.db.commit()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self.db.close()
+
+
+def contentHash(image):
+    """
+    Hashes the contents of an image file, or the pixels of an image in memory. A file's hash
+    is remembered until the file changes.
+
+    `image`: Path to the image, or an image in memory.
+
+    `return`: The hash, as a hex string.
+    """
+    if not isinstance(image, basestring):
+        data, mode = ImageCache.load(image)
+        digest = hashlib.sha1('%s %s ' % (mode, data.shape))
+        digest.update(numpy.ascontiguousarray(data).data)
+        return digest.hexdigest()
+
+    key = ImageCache.fileKey(image)
+    if key not in _hashes:
+        digest = hashlib.sha1()
+        with open(image, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(2**20), ''):
+                digest.update(chunk)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def mergeConfig(merger, connectivity=4, groups=None):
+    """
+    Describes everything about a merger that changes the groups it finds: its remote and
+    commands with their settings, and the scale, regions, pyramid and sampling it merges
+    with, along with the grouping connectivity and cleanup.
+
+    `merger`: The merger.
+
+    `connectivity`: The connectivity the groups are made with.
+
+    `groups`: The group container whose cleanup settings are used, if any.
+
+    `return`: A JSON compatible description.
+    """
+    processor = merger.processor
+    commands = [type(processor).__name__]
+    for command in (processor.checkcmd, processor.actcmd):
+        settings = dict((name, getattr(command, name)) for name in dir(command)
+                        if not name.startswith('_') and not callable(getattr(command, name)))
+        commands.append([type(command).__name__, settings])
+    cleanup = None
+    if groups is not None: cleanup = [groups.opening, groups.closing, groups.minArea]
+    return [commands, merger.scale, merger.regions, merger.pyramid, merger.pyramidTile, merger.pyramidMargin,
+            merger.sample, connectivity, json.loads(json.dumps(cleanup, default=lambda kernel: kernel.tolist()))]
+
+
+def _pack(groups):
+    """
+    Packs a group container into bytes. Each group's box, in the pixels it was found in, and
+    the scale it was rescaled by are stored with its pixels as a bit packed mask of the box.
+    """
+    boxes = numpy.zeros((len(groups.groups), 5), numpy.int64)
+    masks = []
+    for index, group in enumerate(groups.groups):
+        low = group.points.min(axis=0)
+        width, height = (group.points.max(axis=0) - low + 1).tolist()
+        mask = numpy.zeros((height, width), bool)
+        mask[group.points[:, 1] - low[1], group.points[:, 0] - low[0]] = True
+        boxes[index] = low[0], low[1], width, height, group.scale
+        masks.append(numpy.packbits(mask))
+    masks = numpy.concatenate(masks) if masks else numpy.zeros(0, numpy.uint8)
+
+    fp = io.BytesIO()
+    numpy.savez_compressed(fp, boxes=boxes, masks=masks)
+    return fp.getvalue()
+
+
+def _unpack(data):
+    """
+    Rebuilds a group container packed by _pack.
+    """
+    arrays = numpy.load(io.BytesIO(data))
+    boxes, masks = arrays['boxes'], arrays['masks']
+    groups = PixelProcess.GroupContainer()
+    offset = 0
+    for x, y, width, height, scale in boxes.tolist():
+        length = (width * height + 7) // 8
+        mask = numpy.unpackbits(masks[offset:offset + length])[:width * height].reshape(height, width)
+        offset += length
+        ys, xs = numpy.nonzero(mask)
+        group = PixelProcess.PixelGroup(numpy.column_stack((xs + x, ys + y)))
+        if scale != 1: group.rescale(scale)
+        groups.add(group)
+    return groups
@@ -0,0 +1,193 @@
+import os
+import tempfile
+
+import numpy
+from PIL import Image
+
+import PixelProcess
+
+
+class StreamMerger(object):
+
+    def __init__(self, outfile, budget=64 * 2**20):
+        """
+        A stream merger does the same work as a Merger, but never holds a whole image in
+        memory. The base image and every merged image are read in matching bands of rows,
+        each band is merged with the remote's block commands, and the band is written to the
+        outfile before the next one is read. The band height is picked so one band and its
+        working arrays fit in the memory budget.
+        Inputs are read a band at a time when they are stored uncompressed in one piece, as
+        PPM, uncompressed TIFF or .npy files are. Other formats, such as JPEG, have to be
+        decoded whole. Each is decoded in turn into a temporary .npy file before merging
+        starts, so only one is ever held in memory, and the files are removed afterwards.
+        Convert very large inputs once before streaming them to skip this.
+        The outfile must be a .npy or, for RGB images, a .ppm file, as those can be written
+        incrementally.
+
+        `outfile`: The file address to save the output to.
+
+        `budget`: The number of bytes a band may use while it is merged.
+        """
+        self.outfile = outfile
+        self.budget = budget
+
+        self.processor = PixelProcess.PixelRemote()
+
+    def merge(self, base, *images):
+        """
+        Merges any number of images onto the base, band by band, and writes the result to the
+        outfile. The result is the same as a Merger merging the base followed by each image.
+        Changed pixels are recorded as usual if the processor is an ExtractPixelRemote.
+
+        `base`: Path of the image the others are merged onto.
+
+        `images`: Any number of image paths to merge onto the base.
+
+        `return`: The number of modified pixels, summed over all the images.
+        """
+        if not self.processor.canRunBlock():
+            raise ValueError('Streaming merges need check and act commands with executeBlock.')
+
+        spilled = []
+        try:
+            basedata = openBands(base, spilled)
+            comparedata = [openBands(image, spilled) for image in images]
+            height, width = basedata.shape[:2]
+            for data in [basedata] + comparedata:
+                if data.ndim != 3 or data.shape[2] not in (3, 4) or data.shape[2] != basedata.shape[2] \
+                        or data.shape[0] < height or data.shape[1] < width:
+                    raise ValueError('Images must be RGB or RGBA in the same mode, and cover the base.')
+
+            writer = BandWriter(self.outfile, basedata.shape)
+            rows = self.bandRows(width, basedata.shape[2])
+            counter = 0
+            try:
+                for top in xrange(0, height, rows):
+                    band = numpy.array(basedata[top:top + rows])
+                    for data in comparedata:
+                        counter += self.processor.runBlock(band, data[top:top + rows, :width], 0, top)
+                    writer.write(band)
+            finally:
+                writer.close()
+        finally:
+            basedata = comparedata = data = None
+            for path in spilled:
+                os.remove(path)
+        return counter
+
+    def bandRows(self, width, channels):
+        """
+        Finds how many rows fit in a band. Each channel value of a band costs its own byte
+        plus the int16 temporaries the check commands build, which is allowed for with a
+        generous per value cost.
+
+        `width`: Width of the images in pixels.
+
+        `channels`: Number of channels per pixel.
+
+        `return`: The number of rows per band, at least one.
+        """
+        return max(1, self.budget // (width * channels * _bytesPerValue))
+
+
+_bytesPerValue = 10
+
+
+def openBands(path, spilled=None):
+    """
+    Opens an image as an array that can be sliced into bands of rows. Images mapImage can
+    map are memory mapped, so only the rows that are sliced are read. Any other image is
+    decoded in full.
+
+    `path`: Path to the image.
+
+    `spilled`: If given, a decoded image is written to a temporary .npy file, which is
+    mapped instead and its path added to this list. The caller removes the files.
+
+    `return`: An array of shape (height, width, channels).
+    """
+    data = mapImage(path)
+    if data is not None: return data
+    data = numpy.asarray(Image.open(path))
+    if spilled is None: return data
+
+    handle, name = tempfile.mkstemp('.npy')
+    os.close(handle)
+    spilled.append(name)
+    numpy.save(name, data)
+    del data
+    return numpy.load(name, mmap_mode='r')
+
+
+def mapImage(path):
+    """
+    Memory maps an image, if it is a .npy file or is stored as a single uncompressed tile in
+    its own RGB or RGBA mode, as PPM and uncompressed TIFF files are. Reading part of the
+    array only reads that part of the file.
+
+    `path`: Path to the image.
+
+    `return`: A read only array of shape (height, width, channels), or None if the image
+    can't be mapped.
+    """
+    if path.lower().endswith('.npy'):
+        return numpy.load(path, mmap_mode='r')
+
+    image = Image.open(path)
+    if len(image.tile) == 1 and image.mode in ('RGB', 'RGBA'):
+        decoder, box, offset, args = image.tile[0]
+        if not isinstance(args, tuple): args = (args,)
+        args = args + (0, 1)[len(args) - 1:]
+        width, height = image.size
+        channels = len(image.mode)
+        if decoder == 'raw' and box == (0, 0, width, height) and args[0] == image.mode \
+                and args[1] in (0, width * channels) and args[2] == 1:
+            return numpy.memmap(path, numpy.uint8, 'r', offset, (height, width, channels))
+    return None
+
+
+class BandWriter(object):
+
+    def __init__(self, outfile, shape):
+        """
+        Writes an image to disk one band of rows at a time. A .npy outfile is written through
+        a memory map, a .ppm outfile is written as a raw RGB stream after its header.
+
+        `outfile`: Path to write to, ending in .npy or .ppm.
+
+        `shape`: The (height, width, channels) of the whole image.
+        """
+        self.row = 0
+        self.fp = None
+        self.data = None
+
+        if outfile.lower().endswith('.npy'):
+            self.data = numpy.lib.format.open_memmap(outfile, 'w+', numpy.uint8, shape)
+        elif outfile.lower().endswith('.ppm') and shape[2] == 3:
+            self.fp = open(outfile, 'wb')
+            self.fp.write('P6\n%d %d\n255\n' % (shape[1], shape[0]))
+        else:
+            raise ValueError('Streamed output must be a .npy file, or a .ppm file for RGB images.')
+
+    def write(self, band):
+        """
+        Writes the next band of rows.
+
+        `band`: Array of rows, continuing from the last band written.
+        """
+        if self.fp is not None:
+            self.fp.write(numpy.ascontiguousarray(band).tostring())
+        else:
+            self.data[self.row:self.row + len(band)] = band
+            self.data.flush()
+        self.row += len(band)
+
+    def close(self):
+        """
+        Finishes the file.
+        """
+        if self.fp is not None:
+            self.fp.close()
+        if self.data is not None:
+            self.data.flush()
+            self.data = None
@@ -1,5 +1,14 @@
+import BackgroundModel
+import CropSearch
+import FrameSource
+import FrameStore
+import ImageCache
 import ImageMerge
+import ImageWriter
+import Metrics
 import PixelProcess
+import ResultStore
+import StreamMerge
 import homography_demo
 
-__all__ = ['ImageMerge', 'PixelProcess', 'homography_demo']
\ No newline at end of file
+__all__ = ['BackgroundModel', 'CropSearch', 'FrameSource', 'FrameStore', 'ImageCache', 'ImageMerge', 'ImageWriter', 'Metrics', 'PixelProcess', 'ResultStore', 'StreamMerge', 'homography_demo']
\ No newline at end of file
@@ -10,6 +10,7 @@ from PIL import Image, ImageFont, ImageDraw
 
 import Console
 import images2gif
+from Merging import FrameStore, ImageCache, ResultStore
 from gif_player import gif_player
 
 
@@ -25,23 +26,42 @@ class Homography():
     Finally they are applied to a gif manufacturing pre-fab, images2gif.py, which creates a gif file to be displayed
     """
 
-    def __init__(self, base_imgs, test_imgs,):
+    def __init__(self, base_imgs, test_imgs, store=None, results=None):
         """
         constructor for one Homography instance
 
         `base_imgs` images to be used in image merge process, without object being examined
         `test_imgs` images to be used in image merge process, with object being examined
+        `store` optional directory of a frame store, images held in it are memory mapped instead of decoded
+        `results` optional database file of a result store, groups found for a pair before are read back from it
         """
         self.base_imgs = base_imgs
         self.test_imgs = test_imgs
+        self.results = results
+        self.result_store = None
+        if store is not None:
+            store = FrameStore.FrameStore(store)
+            self.base_imgs = [store.lookup(path) for path in base_imgs]
+            self.test_imgs = [store.lookup(path) for path in test_imgs]
 
     def exe(self, gif_path, dest_index, save_first_frame=False):
 
+        # one result store is shared by every merge of the run
+        if self.results is not None: self.result_store = ResultStore.ResultStore(self.results)
+        try:
+            self.exe_frames(gif_path, dest_index, save_first_frame)
+        finally:
+            if self.result_store is not None: self.result_store.close()
+            self.result_store = None
+
+    def exe_frames(self, gif_path, dest_index, save_first_frame):
+
         args_count = 0
 
         frames_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gif_test', 'frames')
 
-        im_dst = cv2.imread(self.base_imgs[dest_index])
+        # decoded images are shared with the merges in obtain_dimensions through the image cache
+        im_dst = ImageCache.array(self.base_imgs[dest_index], bgr=True)
 
         pts_dst = np.array(self.obtain_dimensions(self.base_imgs[dest_index], self.test_imgs[dest_index]))
 
@@ -55,7 +75,7 @@ class Homography():
         for index in xrange(0, len(self.base_imgs)):
             args_count += 1
 
-            im_src = cv2.imread(self.test_imgs[index])
+            im_src = ImageCache.array(self.test_imgs[index], bgr=True)
 
             pts_src = np.array(self.obtain_dimensions(self.base_imgs[index], self.test_imgs[index]))
 
@@ -122,11 +142,9 @@ class Homography():
         consolas.do_redhighlight(None)
         consolas.do_colordiff(120)
 
-        consolas.do_merge(base_file)
-        consolas.do_merge(obj_file)
-
-        consolas.do_gengroups(None)
-        consolas.do_countsortgroups(None)
+        consolas.store = self.result_store
+        consolas.do_pairgroups(base_file + ' ' + obj_file)
+        consolas.do_topgroups(None)
         f = consolas.groups.first()
 
         # corners of object from merge
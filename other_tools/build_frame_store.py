@@ -0,0 +1,24 @@
+import sys
+
+from Merging import FrameStore
+
+"""
+Decodes a directory of images into a frame store of raw .npy pixel files with an index, so that repeated
+analyses memory map the frames instead of decoding them. Running it again on the same store only decodes
+the images that were added or changed since.
+Usage: build_frame_store.py <image directory> <store directory>
+"""
+
+if __name__ == '__main__':
+    """
+    run-me
+    """
+
+    if len(sys.argv) != 3:
+        print 'Usage: build_frame_store.py <image directory> <store directory>'
+        sys.exit(1)
+
+    store = FrameStore.build(sys.argv[1], sys.argv[2])
+    print len(store.names()), 'frames stored in', store.path
+
+    sys.exit(0)
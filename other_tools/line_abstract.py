@@ -33,32 +33,26 @@ def open_cv_method():
 
 def test_open_cv():
 
-    inp1_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Output', 'dump.jpg')
-    inp2_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Output', 'black.jpg')
-
     img = cv2.imread('Input/Two Infrared.jpg')
 
     edges = cv2.Canny(img, 50, 250, apertureSize=3)
 
     im = Image.fromarray(edges)
     im = im.convert("RGB")
-    im.save(inp1_file)
-
-    temp = Image.open(inp1_file)
 
-    img2 = Image.new("RGBA", temp.size)
-    img2.save(inp2_file)
+    img2 = Image.new("RGB", im.size)
 
     consolas = Console.Console(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Output', 'ImF.jpg'))
     consolas.do_extractremote(None)
     consolas.do_redhighlight(None)
     consolas.do_colordiff(120)
 
-    consolas.do_merge(inp1_file)
-    consolas.do_merge(inp2_file)
+    # the frames are merged straight from memory, rather than written out and read back
+    consolas.m.merge(im)
+    consolas.m.merge(img2)
 
     consolas.do_gengroups(None)
-    consolas.do_countsortgroups(None)
+    consolas.do_topgroups(None)
     f = consolas.groups.first()
     print f
 